@@ -0,0 +1,72 @@
+"""
+Versioned cache keys.
+Cached values are keyed by the current version of their namespace so bumping the version invalidates them all at
+once; the stale entries are never read again and simply expire.
+"""
+import time
+
+from django.core.cache import cache
+
+CATEGORY_TREE = 'category-tree'  # rendered category trees
+DOCUMENT_MEMBERSHIP = 'document-membership'  # documents listed by category membership (e.g. orphan documents)
+
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+VALUE_TIMEOUT = 60 * 60 * 24
+
+
+def version_key(namespace):
+    return 'docmeta:version:{0}'.format(namespace)
+
+
+def new_version():
+    """
+    :return: a version that will not repeat one used before the version key was evicted
+    """
+    return int(time.time() * 1000)
+
+
+def get_version(namespace):
+    """
+    :return: current version of namespace
+    """
+    key = version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, new_version(), VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    """
+    Invalidate everything cached under namespace
+    :return: the new version
+    """
+    key = version_key(namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:  # not cached (or evicted)
+        version = new_version()
+        cache.set(key, version, VERSION_TIMEOUT)
+        return version
+
+
+def versioned_key(namespace, *parts):
+    """
+    :return: cache key for parts under the current version of namespace
+    """
+    return u':'.join([u'docmeta', namespace, unicode(get_version(namespace))] + [unicode(part) for part in parts])
+
+
+def get_or_set(namespace, parts, compute, timeout=VALUE_TIMEOUT):
+    """
+    :param parts: sequence of the parts of the value's key within namespace
+    :param compute: function returning the value if it isn't cached
+    :return: the value cached for parts under the current version of namespace
+    """
+    key = versioned_key(namespace, *parts)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
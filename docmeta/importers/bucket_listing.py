@@ -0,0 +1,185 @@
+"""
+List the keys of a storage bucket in parallel.
+
+The keyspace is sharded by prefix (split as many delimiter levels deep as needed to give every worker a shard) and
+each shard is listed by its own worker thread. The last key handled in each shard
+can be checkpointed to a json file so that an interrupted listing resumes from those markers instead of from scratch.
+"""
+import os
+import sys
+import json
+import threading
+from Queue import Queue
+from collections import deque
+
+from boto.s3.key import Key
+from django.utils import six
+
+
+class ShardedBucketLister(object):
+    """
+    Lists a bucket as a set of prefix shards, each listed concurrently using its own connection.
+    Keys within a shard arrive in key order so the last handled key is a valid resume marker for that shard.
+    """
+    root_shard = ''  # keys that are not within any prefix
+    queue_size = 10000  # bounds memory if listing outpaces the consumer
+    checkpoint_interval = 100  # handled keys between checkpoint writes
+
+    def __init__(self, bucket_factory, checkpoint_filename=None, prefixes=None, workers=8, delimiter='/'):
+        """
+        :param bucket_factory: callable returning a bucket; called once per worker as connections are not thread safe
+        :param checkpoint_filename: json file used to record/resume shard markers (no checkpointing if None)
+        :param prefixes: explicit shard prefixes, otherwise prefixes are discovered by find_prefixes
+        :param workers: number of concurrent listing threads (connections)
+        :param delimiter: key path delimiter used to discover the prefixes
+        """
+        super(ShardedBucketLister, self).__init__()
+        self.bucket_factory = bucket_factory
+        self.checkpoint_filename = checkpoint_filename
+        self.workers = workers
+        self.delimiter = delimiter
+        self.unsaved_checkpoints = 0
+        self.unacknowledged = dict()  # shard: number of keys yielded but not yet checkpointed
+        self.listed = set()  # shards whose keys have all been yielded but not all checkpointed
+
+        checkpoint = self.read_checkpoint()
+        if checkpoint is None:
+            if prefixes is not None:
+                self.shards = list(prefixes)
+                self.direct_shards = set([self.root_shard])  # keys outside the explicit prefixes
+            else:
+                self.shards, self.direct_shards = self.find_prefixes()
+            self.markers = dict()
+            self.completed = set()
+        else:  # resume using the shards of the interrupted listing
+            self.shards = checkpoint['shards']
+            self.direct_shards = set(checkpoint.get('direct', [self.root_shard]))
+            self.markers = checkpoint['markers']
+            self.completed = set(checkpoint['completed'])
+
+    def find_prefixes(self):
+        """
+        Split the bucket one delimiter level deeper at a time (breadth first) until there are at least as many
+        prefixes as workers or no prefix has subprefixes. Each split prefix leaves a direct shard for the keys
+        immediately within it.
+        :return: list of shard prefixes, set of the direct shards among them
+        """
+        bucket = self.bucket_factory()
+        shards = list()
+        direct_shards = set()
+        prefixes = deque([self.root_shard])
+        while prefixes and len(prefixes) < self.workers:
+            prefix = prefixes.popleft()
+            shards.append(prefix)
+            direct_shards.add(prefix)
+            prefixes.extend(item.name for item in bucket.list(prefix=prefix, delimiter=self.delimiter)
+                            if not isinstance(item, Key))
+        return shards + list(prefixes), direct_shards
+
+    def read_checkpoint(self):
+        if self.checkpoint_filename is None or not os.path.exists(self.checkpoint_filename):
+            return None
+        with open(self.checkpoint_filename) as f:
+            return json.load(f)
+
+    def write_checkpoint(self):
+        if self.checkpoint_filename is None:
+            return
+        temp_filename = '{0}.tmp'.format(self.checkpoint_filename)
+        with open(temp_filename, 'w') as f:
+            json.dump({'shards': self.shards,
+                       'direct': sorted(self.direct_shards),
+                       'markers': self.markers,
+                       'completed': sorted(self.completed)}, f)
+        os.rename(temp_filename, self.checkpoint_filename)  # never leave a half written checkpoint
+        self.unsaved_checkpoints = 0
+
+    def remove_checkpoint(self):
+        if self.checkpoint_filename is not None and os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+
+    def complete_shard(self, shard):
+        """
+        Record that every key of shard has been handled. Once all shards are complete the checkpoint is removed so
+        the next listing starts afresh.
+        """
+        self.listed.discard(shard)
+        self.completed.add(shard)
+        if len(self.completed) == len(self.shards):
+            self.remove_checkpoint()
+            return True
+        return False
+
+    def checkpoint(self, shard, key):
+        """
+        Record that key (and so every earlier key in its shard) has been handled.
+        """
+        self.markers[shard] = key.name
+        self.unacknowledged[shard] -= 1
+        if not self.unacknowledged[shard] and shard in self.listed and self.complete_shard(shard):
+            return
+        self.unsaved_checkpoints += 1
+        if self.unsaved_checkpoints >= self.checkpoint_interval:
+            self.write_checkpoint()
+
+    def list_shard(self, bucket, shard):
+        marker = self.markers.get(shard, '')
+        if shard in self.direct_shards:  # only the keys immediately within the prefix
+            for item in bucket.list(prefix=shard, delimiter=self.delimiter, marker=marker):
+                if isinstance(item, Key):
+                    yield item
+        else:
+            for key in bucket.list(prefix=shard, marker=marker):
+                yield key
+
+    def run_worker(self, shards, results):
+        try:
+            bucket = self.bucket_factory()
+            while True:
+                shard = shards.get()
+                if shard is None:
+                    break
+                for key in self.list_shard(bucket, shard):
+                    results.put(('key', shard, key))
+                results.put(('done', shard, None))
+        except Exception:
+            results.put(('error', None, sys.exc_info()))
+
+    def list(self):
+        """
+        Yield (shard, key) for every key not handled by an earlier (interrupted) listing.
+        Call checkpoint(shard, key) once each key has been handled; a shard is only recorded as complete when all of
+        its keys have been.
+        """
+        pending = [shard for shard in self.shards if shard not in self.completed]
+        shards = Queue()
+        for shard in pending:
+            shards.put(shard)
+        results = Queue(maxsize=self.queue_size)
+        for _ in range(self.workers):
+            shards.put(None)  # one stop marker per worker
+            worker = threading.Thread(target=self.run_worker, args=(shards, results))
+            worker.daemon = True  # don't hang the process if the consumer gives up
+            worker.start()
+
+        remaining = len(pending)
+        all_complete = False
+        try:
+            while remaining:
+                kind, shard, item = results.get()
+                if kind == 'key':
+                    self.unacknowledged[shard] = self.unacknowledged.get(shard, 0) + 1
+                    yield shard, item
+                elif kind == 'done':
+                    remaining -= 1
+                    if self.unacknowledged.get(shard):  # keys still to be checkpointed
+                        self.listed.add(shard)
+                    else:
+                        all_complete = self.complete_shard(shard)
+                else:
+                    six.reraise(*item)
+        finally:
+            if not all_complete:
+                self.write_checkpoint()
+        if not pending:
+            self.remove_checkpoint()
@@ -0,0 +1,58 @@
+import os
+import csv
+import codecs
+
+from docmeta.importers.excel_importer import XLImporter
+from docmeta.importers.staging_importer import StagingImporter
+
+
+class CSVImporter(XLImporter):
+    """
+    Import the CCCS sheet exported as delimited text (CSV or TSV) using the XLImporter column_specs and transforms.
+    Rows are streamed with the csv module so this is much faster than parsing the workbook and memory use is
+    constant. Empty cells are read as None (as they are from the workbook) and all other values as unicode text.
+    """
+    extensions = ('.csv', '.tsv', '.tab', '.txt')
+    tab_extensions = ('.tsv', '.tab')
+    encoding = 'utf-8'
+
+    def __init__(self, source_file, delimiter=None, **kwargs):
+        """
+        :param source_file: name of the delimited text file
+        :param delimiter: field delimiter, by default tab for .tsv/.tab files and comma otherwise
+        """
+        self.delimiter = delimiter
+        super(CSVImporter, self).__init__(source_file, **kwargs)
+
+    def open_source(self, source_file, streaming):
+        self.source_filename = source_file
+        if self.delimiter is None:
+            extension = os.path.splitext(source_file)[1].lower()
+            self.delimiter = '\t' if extension in self.tab_extensions else ','
+
+    def iter_text_rows(self):
+        """
+        Yield each line of the source file as a list of unicode values
+        """
+        with open(self.source_filename, 'rb') as f:
+            for line_number, row in enumerate(csv.reader(f, delimiter=self.delimiter)):
+                if line_number == 0 and row and row[0].startswith(codecs.BOM_UTF8):
+                    row[0] = row[0][len(codecs.BOM_UTF8):]
+                yield [value.decode(self.encoding) if value else None for value in row]
+
+    def find_column_headings(self):
+        rows = self.iter_text_rows()
+        for _ in range(self.heading_row):
+            next(rows)
+        return [value for value in next(rows) if value is not None]
+
+    def iter_rows(self):
+        column_names = [s[0] for s in self.column_specs]
+        return self.iter_row_tuples(self.iter_text_rows(), column_names, self.heading_row, self.heading_row+1)
+
+
+class CSVStagingImporter(CSVImporter, StagingImporter):
+    """
+    Delimited text import merged through staging tables
+    """
+    pass
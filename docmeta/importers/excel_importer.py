@@ -1,14 +1,21 @@
-import os
+import json
+import hashlib
 import datetime
-import difflib
+import itertools
 import dateutil.parser as dp
 
 from collections import defaultdict
 from openpyxl import load_workbook
 
 from django.contrib.auth.models import User
+from django.db import transaction
+from taggit.models import Tag
 
 import docmeta.models as dm
+from docmeta.importers.relation_batch import (RelationBatch, create_missing_named, create_named, in_batches,
+                                              normalize_name)
+from docmeta.utils.fuzzy_index import TrigramIndex
+from docmeta.utils.lru_memo import LRUMemo
 
 
 class MoreThanOneDocumentFoundError(Exception):
@@ -19,8 +26,92 @@ class NoDocumentFoundError(Exception):
     pass
 
 
+def cell_value(cell):
+    """
+    :return: value of a full (Cell) or streamed (RawCell) worksheet cell
+    """
+    try:
+        return cell.value
+    except AttributeError:  # streamed cells only have the internal value
+        return cell.internal_value
+
+
+def worksheet_rows(ws):
+    """
+    :return: iterator over the rows of ws, lazily if ws is streamed (read only)
+    """
+    try:
+        return ws.iter_rows()
+    except AttributeError:
+        return iter(ws.rows)
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of up to size consecutive items from iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def parse_int(raw_int):
+    """
+    :return: raw_int as an int or None if it is not an integer
+    """
+    try:
+        return int(raw_int)
+    except ValueError:
+        return None
+
+
+def parse_date(raw_date):
+    """
+    :return: datetime for raw_date or None if it can't be parsed
+    """
+    if isinstance(raw_date, datetime.datetime):
+        # openpyxl has managed to parse it
+        return raw_date
+    # parse using dateutil
+    try:
+        return dp.parse(raw_date)
+    except TypeError:  # give up
+        return None
+
+
+def parse_publication_date(raw_publication_date):
+    """
+    :return: ((attname, value), ...) for the year (and the month and day if given) of the publication date
+    """
+    try:
+        return (('year', int(raw_publication_date)),)
+    except (ValueError, TypeError):
+        pass
+
+    if isinstance(raw_publication_date, datetime.datetime):
+        # openpyxl managed to parse it
+        publication_date = raw_publication_date
+    else:
+        # parse using dateutil
+        publication_date = dp.parse(raw_publication_date)
+    return tuple((attname, getattr(publication_date, attname)) for attname in ('year', 'month', 'day'))
+
+
 class XLImporter(object):
     heading_row = 1  # Why :(
+    chunk_size = 500  # rows processed together
+    sheet_name = 'INPEX docs'
+    filename_column = u'original file name'  # identifies the documents for a row
+
+    # pure value parsers of the transforms; each column gets its own memo of these
+    value_parsers = {
+        'date': parse_date,
+        'copy_int': parse_int,
+        'publication_date': parse_publication_date}
+    memo_size = 1024
 
     # field_spec is a (<column_name>, <transform_method_suffix>, <method kwargs>) for the field.
     column_specs = [
@@ -71,15 +162,27 @@ class XLImporter(object):
         (u'L4 Geographical Admin. Cat.', 'copy', {'field': 'l4'}),
         (u'L5 Geographical Admin. Cat.', 'copy', {'field': 'l5'})]
     
-    def __init__(self, source_file):
+    def __init__(self, source_file, streaming=False, force=False):
+        """
+        :param source_file: excel file name or file object
+        :param streaming: if True the workbook is opened read only and its rows are read lazily so memory use does
+        not depend on the size of the sheet.
+        :param force: if True rows are loaded even if they are unchanged since they were last imported
+        """
         super(XLImporter, self).__init__()
-        self.workbook = load_workbook(source_file)
-        self.inpex_docs_ws = self.workbook.get_sheet_by_name('INPEX docs')
+        self.open_source(source_file, streaming)
 
-        document_lookup = defaultdict(list)
-        for document_filename in dm.DocumentFileName.objects.all():
-            document_lookup[os.path.basename(document_filename.name)].append(document_filename.document)
-        self.document_lookup = document_lookup
+        # rows are tuples of the column_specs column values
+        self.filename_index = [s[0] for s in self.column_specs].index(self.filename_column)
+        self.fingerprint_columns = [(column_name, column_index)
+                                    for column_index, (column_name, suffix, _) in enumerate(self.column_specs)
+                                    if suffix]
+        self.plan = self.compile_plan()
+
+        self.force = force
+        self.fingerprints = dict(dm.ImportRowFingerprint.objects.filter(
+            source_sheet=self.sheet_name).values_list('document_id', 'fingerprint'))
+        self.loaded_document_ids = set()  # documents loaded by this import
 
         user_lookup = dict()
         for user in User.objects.all():
@@ -87,85 +190,275 @@ class XLImporter(object):
             long_name = u'{0} {1}'.format(user.first_name, user.last_name).lower()
             user_lookup[long_name] = user
         self.user_lookup = user_lookup
+        self.user_index = TrigramIndex(user_lookup.keys())
 
         named_relations = dict()
+        named_relation_indexes = dict()
         model_classes = [kwargs['model'] for _, suffix, kwargs in self.column_specs if suffix == 'fk_named']
         for model_class in model_classes:
             model_lookup = dict()
             named_relations[model_class] = model_lookup
             for obj in model_class.objects.all():
                 model_lookup[obj.name.strip().lower()] = obj
+            named_relation_indexes[model_class] = TrigramIndex(model_lookup.keys())
         self.named_relations = named_relations
+        self.named_relation_indexes = named_relation_indexes
+
+        self.relation_batch = RelationBatch()
+
+        # raw string resolutions so each distinct value is only matched once
+        self.resolved_users = dict()
+        self.resolved_named_relations = dict()
 
     def find_user(self, raw_name):
-        key = raw_name.strip().lower()
         try:
-            return self.user_lookup[key]
+            user = self.resolved_users[raw_name]
         except KeyError:
-            close_enough = difflib.get_close_matches(key, self.user_lookup.keys(), 1)
-            if close_enough:
-                return self.user_lookup[close_enough[0]]
-            else:
-                raise
+            key = raw_name.strip().lower()
+            try:
+                user = self.user_lookup[key]
+            except KeyError:
+                close_enough = self.user_index.get_close_match(key)
+                user = None if close_enough is None else self.user_lookup[close_enough]
+            self.resolved_users[raw_name] = user
+
+        if user is None:
+            raise KeyError(raw_name)
+        return user
 
     def find_named_relation(self, model_class, raw_name):
+        try:
+            return self.resolved_named_relations[(model_class, raw_name)]
+        except KeyError:
+            pass
+
         key = raw_name.strip().lower()
         try:
-            return self.named_relations[model_class][key]
+            relation = self.named_relations[model_class][key]
         except KeyError:
-            close_enough = difflib.get_close_matches(key, self.named_relations[model_class].keys(), 1)
-            if close_enough:
-                return self.named_relations[model_class][close_enough[0]]
+            close_enough = self.named_relation_indexes[model_class].get_close_match(key)
+            if close_enough is not None:
+                relation = self.named_relations[model_class][close_enough]
             else:
-                new_relation = model_class(name=raw_name)
-                new_relation.save()
-                self.named_relations[model_class][key] = new_relation
-                return new_relation
+                relation = create_named(model_class, raw_name)
+                self.named_relations[model_class][key] = relation
+                self.named_relation_indexes[model_class].add(key)
+        self.resolved_named_relations[(model_class, raw_name)] = relation
+        return relation
 
     @staticmethod
-    def get_worksheet_dicts(ws, column_names, heading_row=0, starting_row=1):
+    def iter_row_tuples(rows, column_names, heading_row=0, starting_row=1):
+        """
+        Lazily yield a tuple of the column_names values for each of rows (sequences of values).
+        The rows are read in a single pass so this works for streamed sources.
+        """
+        rows = iter(rows)
+        for _ in range(heading_row):
+            next(rows)
 
-        # create column_name, column_index pairings for the extraction
-        column_headings = [c.value for c in ws.rows[heading_row]]
+        # find the index of each column for the extraction
+        column_headings = list(next(rows))
         for column_name in column_names:
             if column_name not in column_headings:
                 raise Exception("{0} is not a column heading".format(column_name))
-        column_info = [(column_name, column_headings.index(column_name)) for column_name in column_names]
+        column_indexes = [column_headings.index(column_name) for column_name in column_names]
 
-        return [{column_name: row[column_index].value
-                 for (column_name, column_index) in column_info}
-                for row in ws.rows[starting_row:]]
+        for _ in range(starting_row - heading_row - 1):
+            next(rows)
+        for row in rows:
+            row_length = len(row)
+            yield tuple(row[column_index] if column_index < row_length else None for column_index in column_indexes)
+
+    @classmethod
+    def iter_row_dicts(cls, rows, column_names, heading_row=0, starting_row=1):
+        """
+        Lazily yield a {column_name: value} dict for each of rows (sequences of values).
+        """
+        for values in cls.iter_row_tuples(rows, column_names, heading_row, starting_row):
+            yield dict(zip(column_names, values))
+
+    @staticmethod
+    def iter_worksheet_values(ws):
+        return ([cell_value(c) for c in row] for row in worksheet_rows(ws))
+
+    @classmethod
+    def iter_worksheet_dicts(cls, ws, column_names, heading_row=0, starting_row=1):
+        """
+        Lazily yield a {column_name: value} dict for each row of ws (which may be streamed).
+        """
+        return cls.iter_row_dicts(cls.iter_worksheet_values(ws), column_names, heading_row, starting_row)
+
+    @classmethod
+    def get_worksheet_dicts(cls, ws, column_names, heading_row=0, starting_row=1):
+        return list(cls.iter_worksheet_dicts(ws, column_names, heading_row, starting_row))
+
+    def open_source(self, source_file, streaming):
+        self.workbook = load_workbook(source_file, use_iterators=streaming)
+        self.inpex_docs_ws = self.workbook.get_sheet_by_name(self.sheet_name)
 
     def find_column_headings(self):
-        return [c.value for c in self.inpex_docs_ws.rows[self.heading_row] if c.value is not None]
+        rows = worksheet_rows(self.inpex_docs_ws)
+        for _ in range(self.heading_row):
+            next(rows)
+        return [cell_value(c) for c in next(rows) if cell_value(c) is not None]
 
-    def load(self):
+    def iter_rows(self):
+        """
+        :return: iterator of tuples of the column_specs column values for the sheet rows
+        """
         column_names = [s[0] for s in self.column_specs]
-        rows = self.get_worksheet_dicts(self.inpex_docs_ws, column_names, self.heading_row, self.heading_row+1)
+        return self.iter_row_tuples(self.iter_worksheet_values(self.inpex_docs_ws),
+                                    column_names, self.heading_row, self.heading_row+1)
+
+    @staticmethod
+    def find_documents(filenames):
+        """
+        :param filenames: file basenames
+        :return: {basename: [document, ...]} for the documents with a file named in filenames
+        """
+        document_lookup = defaultdict(list)
+        for batch in in_batches(set(filenames)):
+            for document_filename in dm.DocumentFileName.objects.filter(basename__in=batch).select_related('document'):
+                document_lookup[document_filename.basename].append(document_filename.document)
+        return document_lookup
+
+    def iter_document_rows(self, rows):
+        """
+        Yield (document, row) for each document matching each of rows (a chunk of the sheet, so the documents are
+        looked up with a few batched queries)
+        """
+        rows = list(rows)
+        document_lookup = self.find_documents(row[self.filename_index] for row in rows
+                                              if row[self.filename_index] is not None)
         for row in rows:
-            for document in self.document_lookup[row[u'original file name']]:
+            for document in document_lookup.get(row[self.filename_index], ()):
+                yield document, row
+
+    def load(self):
+        for chunk in chunked(self.iter_rows(), self.chunk_size):
+            self.load_rows(chunk)
+
+    def load_rows(self, rows):
+        self.load_document_rows(self.iter_document_rows(rows))
+
+    def load_document_rows(self, document_rows):
+        """
+        Load a chunk of (document, row) pairs in one transaction, writing their m2m relations and tags in bulk at
+        the end. The named objects the rows refer to are created beforehand, outside the chunk transaction.
+        """
+        changed_rows = list()
+        for document, row in document_rows:
+            fingerprint = self.row_fingerprint(row)
+            if self.is_unchanged(document, fingerprint):
+                continue
+            self.loaded_document_ids.add(document.pk)
+            changed_rows.append((document, row, fingerprint))
+        self.create_shared_names([row for _, row, _ in changed_rows])
+
+        new_fingerprints = dict()
+        with transaction.atomic():
+            for document, row, fingerprint in changed_rows:
                 self.load_document_metadata(document, row)
+                new_fingerprints[document.pk] = fingerprint
+            self.relation_batch.flush()
+            self.save_fingerprints(new_fingerprints)
+
+    def create_shared_names(self, rows):
+        """
+        Create the missing authors, editors, tags and other named objects that rows refer to. They are shared with
+        other documents (and so with concurrent imports), so each is committed straight away in a short transaction
+        rather than locked until a chunk transaction commits.
+        """
+        self.resolve_named_relations(rows)
+        names = defaultdict(set)  # model: names
+        for column_index, (_, suffix, kwargs) in enumerate(self.column_specs):
+            if suffix not in ('m2m', 'tag'):
+                continue
+            for row in rows:
+                raw_value = row[column_index]
+                if raw_value is None:
+                    continue
+                if suffix == 'm2m':
+                    names[kwargs['model']].add(normalize_name(raw_value))
+                else:
+                    names[Tag].update(normalize_name(tag_name) for tag_name in unicode(raw_value).split(';'))
+        for model, model_names in sorted(names.items(), key=lambda item: item[0].__name__):
+            create_missing_named(model, [name for name in model_names if name])
+
+    def resolve_named_relations(self, rows):
+        """
+        Resolve the fk_named values of rows, creating the named objects that nothing is close enough to
+        :return: {(model class, raw name): named object}
+        """
+        fk_names = set()  # (model, raw name)
+        for column_index, (_, suffix, kwargs) in enumerate(self.column_specs):
+            if suffix == 'fk_named':
+                fk_names.update((kwargs['model'], row[column_index]) for row in rows if row[column_index] is not None)
+        return dict(((model, raw_name), self.find_named_relation(model, raw_name))
+                    for model, raw_name in sorted(fk_names, key=lambda item: (item[0].__name__, item[1])))
+
+    def row_fingerprint(self, row):
+        """
+        :return: stable hash of the values of the transformed columns of row
+        """
+        values = [(column_name, row[column_index]) for column_name, column_index in self.fingerprint_columns]
+        serialized = json.dumps(values, default=lambda value: value.isoformat())  # dates are the only non json values
+        return hashlib.sha1(serialized).hexdigest()
+
+    def is_unchanged(self, document, fingerprint):
+        """
+        A row is skipped if it matches the fingerprint from the last import, unless an earlier row has already been
+        loaded into the document by this import (all of its rows must then be loaded to give the same result).
+        """
+        return (not self.force and
+                document.pk not in self.loaded_document_ids and
+                self.fingerprints.get(document.pk) == fingerprint)
+
+    def save_fingerprints(self, fingerprints):
+        if not fingerprints:
+            return
+        dm.ImportRowFingerprint.objects.filter(source_sheet=self.sheet_name,
+                                               document__in=fingerprints.keys()).delete()
+        dm.ImportRowFingerprint.objects.bulk_create([
+            dm.ImportRowFingerprint(document_id=document_id, source_sheet=self.sheet_name, fingerprint=fingerprint)
+            for document_id, fingerprint in fingerprints.items()])
+        self.fingerprints.update(fingerprints)
 
     def load_document_metadata(self, document, row):
-        changed = False
-        for spec in self.column_specs:
-            column_name, transform_suffix, transform_kwargs = spec
+        if self.apply_transforms(document, row):
+            document.save_changed()
+
+    def compile_plan(self):
+        """
+        Compile column_specs into a list of (row index, bound transform method, transform kwargs) so the transform
+        methods are only looked up once. Transforms with a pure value parser get a memo of it for their column.
+        """
+        plan = list()
+        for column_index, (_, transform_suffix, transform_kwargs) in enumerate(self.column_specs):
             if transform_suffix is None:
                 continue
-            transform_methodname = 'transform_{0}'.format(transform_suffix)
-            raw_datum = row[column_name]
-            if raw_datum is None:
-                continue
-            if getattr(self, transform_methodname)(document, raw_datum, **transform_kwargs):
-                changed = True
+            kwargs = dict(transform_kwargs)
+            if transform_suffix in self.value_parsers:
+                kwargs['parse'] = LRUMemo(self.value_parsers[transform_suffix], self.memo_size)
+            plan.append((column_index, getattr(self, 'transform_{0}'.format(transform_suffix)), kwargs))
+        return plan
 
-        if changed:
-            document.save()
+    def apply_transforms(self, document, row):
+        """
+        Apply the column transforms for row to document
+        :return: Boolean - True if document object has changed
+        """
+        changed = False
+        for column_index, transform, transform_kwargs in self.plan:
+            raw_datum = row[column_index]
+            if raw_datum is not None and transform(document, raw_datum, **transform_kwargs):
+                changed = True
+        return changed
 
-    @staticmethod
-    def transform_m2m(document, raw_name, field, model):
+    def transform_m2m(self, document, raw_name, field, model):
         """
         Add m2m named element if it does not exist and add it to document field.
+        The addition is queued and written with the rest of the chunk by load_rows.
         The addition can be performed repeatedly without problem.
         :param document: docmeta document model object
         :param raw_name: supplied name
@@ -173,10 +466,7 @@ class XLImporter(object):
         :param model: model class for m2m target relation
         :return: Boolean - True if document object has changed
         """
-        related_object, created = model.objects.get_or_create(name=raw_name)
-        if created:
-            related_object.save()
-        getattr(document, field).add(related_object)
+        self.relation_batch.add_named(document, field, model, raw_name)
         return False  # m2m does not affect document
 
     @staticmethod
@@ -225,30 +515,30 @@ class XLImporter(object):
 
         return False
 
-    @staticmethod
-    def transform_tag(document, raw_tag_string):
+    def transform_tag(self, document, raw_tag_string):
         """
         Add specified tags to document (tags are separated in raw_tag_string by semi colons)
+        The tags are queued and written with the rest of the chunk by load_rows.
         :param document: docmeta document model object
         :param raw_tag_string: semi colon delimited list of tags
         :return: Boolean - True if document object has changed
         """
-        tags = raw_tag_string.split(';')
-        document.tags.add(*tags)
+        tags = unicode(raw_tag_string).split(';')
+        self.relation_batch.add_tags(document, tags)
         return False  # No change to document model
 
     @staticmethod
-    def transform_copy_int(document, raw_int, field):
+    def transform_copy_int(document, raw_int, field, parse=parse_int):
         """
         Copy raw integer value into the named field
         :param document: docmeta document model object
         :param raw_int: supplied value
         :param field: document field name relating to this transform
+        :param parse: function parsing raw_int
         :return: Boolean - True if document object has changed
         """
-        try:
-            use_int = int(raw_int)
-        except ValueError:
+        use_int = parse(raw_int)
+        if use_int is None:
             return False
 
         if use_int != getattr(document, field):
@@ -261,34 +551,19 @@ class XLImporter(object):
         pass
 
     @staticmethod
-    def transform_publication_date(document, raw_publication_date):
+    def transform_publication_date(document, raw_publication_date, parse=parse_publication_date):
         """
         Break the publication date into the year/month/day fields
         :param document: docmeta document model object
         :param raw_publication_date: supplied value
+        :param parse: function parsing raw_publication_date
         :return: Boolean - True if document object has changed
         """
-        try:
-            year = int(raw_publication_date)
-            if year != document.year:
-                document.year = year
-                return True
-            else:
-                return False
-        except (ValueError, TypeError):
-            pass
-
-        if isinstance(raw_publication_date, datetime.datetime):
-            # openpyxl managed to parse it
-            publication_date = raw_publication_date
-        else:
-            # parse using dateutil
-            publication_date = dp.parse(raw_publication_date)
         changed = False
 
-        for attname in ('year', 'month', 'day'):
-            if getattr(publication_date, attname) != getattr(document, attname):
-                setattr(document, attname, getattr(publication_date, attname))
+        for attname, value in parse(raw_publication_date):
+            if value != getattr(document, attname):
+                setattr(document, attname, value)
                 changed = True
 
         return changed
@@ -313,23 +588,18 @@ class XLImporter(object):
             document.categories.add(subcategory)
 
     @staticmethod
-    def transform_date(document, raw_date, field):
+    def transform_date(document, raw_date, field, parse=parse_date):
         """
         Converte and assign the date
         :param document: docmeta document model object
         :param raw_date if document object has changed
         :param field: document field name relating to this transform
+        :param parse: function parsing raw_date
         :return: Boolean - True if document object has changed
         """
-        if isinstance(raw_date, datetime.datetime):
-            # openpyxl has managed to parse it
-            actual_date = raw_date
-        else:
-            # parse using dateutil
-            try:
-                actual_date = dp.parse(raw_date)
-            except TypeError:  # give up
-                return False
+        actual_date = parse(raw_date)
+        if actual_date is None:
+            return False
 
         if actual_date != getattr(document, field):
             setattr(document, field, actual_date)
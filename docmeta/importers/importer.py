@@ -4,10 +4,18 @@ Create or use categories matching the document folder.
 This should never look at uploaded documents because they will already have metadata objects.
 """
 import os
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
 from storages.backends.s3boto import S3BotoStorage
 
 import docmeta.models as dm
+from docmeta import cache
 from docmeta.importers.excel_importer import XLImporter
+from docmeta.importers.staging_importer import StagingImporter
+from docmeta.importers.csv_importer import CSVImporter, CSVStagingImporter
+from docmeta.importers.parallel_importer import load_parallel
+from docmeta.importers.bucket_listing import ShardedBucketLister
+from docmeta.importers.relation_batch import RelationBatch
 
 
 def upload_files(source_path, root_path='./'):
@@ -28,31 +36,89 @@ def upload_files(source_path, root_path='./'):
                     storage.save(target_fpath, f)
 
 
-def import_files():
+def import_files(checkpoint_filename=None, workers=8, batch_size=500):
     """
     Go through the stored files and ensure that each one has a Document model supporting it.
     Create or use categories matching the document folder structure unless the folder is numeric.
+    Categories are resolved from an in memory cache and the category trees are rebuilt once at the end.
+    The bucket is listed in parallel prefix shards. If checkpoint_filename is given, an interrupted import resumes
+    from the last key handled in each shard.
+    Documents are bulk created in batches with unique names and slugs allocated in memory.
+    :param checkpoint_filename: json file recording the listing progress
+    :param workers: number of concurrent bucket listing connections
+    :param batch_size: number of keys to create documents for at once
     :return:
     """
-    storage = S3BotoStorage()
-    for key in storage.bucket.list():
-        if not dm.Document.objects.filter(source_file=key.name):  # No existing metadata object
-            title = os.path.splitext(os.path.basename(key.name))[0]
-            if title:  # ignore .xxx 'hidden' files
-                document = dm.Document(source_file=key.name,
-                                       title=title)
-                document.save()  # save here so relations are possible
-
-                filename, created = dm.DocumentFileName.objects.get_or_create(
-                    document=document, name=key.name)
-                if created:
-                    filename.save()
-
-                path = os.path.split(key.name)[0]
-                if path:
-                    category_names = path.split(os.path.sep)
-                    categories = dm.verify_categories(category_names, create_if_absent=True)
-                    document.categories.add(categories[-1])
+    lister = ShardedBucketLister(lambda: S3BotoStorage().bucket,
+                                 checkpoint_filename=checkpoint_filename,
+                                 workers=workers)
+    category_cache = dm.CategoryPathCache()
+    name_allocator = dm.UniqueValueAllocator(dm.Document.objects, 'name')
+    slug_allocator = dm.UniqueValueAllocator(dm.Document.objects, 'slug', u'{0}-{1}')
+
+    def flush(batch):
+        create_documents([key.name for _, key in batch], category_cache, name_allocator, slug_allocator)
+        for shard, key in batch:  # only checkpoint keys once their documents exist
+            lister.checkpoint(shard, key)
+
+    with category_cache.deferred_tree_updates():
+        batch = list()
+        for shard, key in lister.list():
+            batch.append((shard, key))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = list()
+        if batch:
+            flush(batch)
+    dm.recount_category_documents()  # the links were bulk created (and the trees renumbered)
+
+
+def create_documents(key_names, category_cache, name_allocator, slug_allocator):
+    """
+    Bulk create documents, with their filenames and folder categories, for the stored files that have none
+    :param key_names: stored file names
+    :param category_cache: CategoryPathCache
+    :param name_allocator: UniqueValueAllocator of Document names
+    :param slug_allocator: UniqueValueAllocator of Document slugs
+    :return: None
+    """
+    existing = set(dm.Document.objects.filter(source_file__in=key_names).values_list('source_file', flat=True))
+    new_documents = list()  # (document, key name)
+    for key_name in key_names:
+        title = os.path.splitext(os.path.basename(key_name))[0]
+        if key_name not in existing and title:  # No existing metadata object (and ignore .xxx 'hidden' files)
+            new_documents.append((dm.Document(source_file=key_name, title=title), key_name))
+            existing.add(key_name)
+    if not new_documents:
+        return
+
+    documents = [document for document, _ in new_documents]
+    dm.prepare_new_documents(documents, name_allocator, slug_allocator)
+    try:
+        with transaction.atomic():
+            dm.Document.objects.bulk_create(documents)
+    except IntegrityError:  # a concurrent save took an allocated name so fall back to saving (with retries)
+        for document in documents:
+            document.save()
+    else:  # bulk_create doesn't set the primary keys
+        ids = dict(dm.Document.objects.filter(name__in=[document.name for document in documents])
+                                      .values_list('name', 'id'))
+        for document in documents:
+            document.id = ids[document.name]
+
+    through = dm.Document.categories.through
+    filenames = list()
+    category_links = list()
+    for document, key_name in new_documents:
+        filenames.append(dm.DocumentFileName(document_id=document.id, name=key_name,
+                                             basename=os.path.basename(key_name)))  # bulk_create skips save()
+        path = os.path.split(key_name)[0]
+        if path:
+            category_names = path.split(os.path.sep)
+            categories = category_cache.verify(category_names, create_if_absent=True)
+            category_links.append(through(document_id=document.id, documentcategory_id=categories[-1].id))
+    dm.DocumentFileName.objects.bulk_create(filenames)
+    through.objects.bulk_create(category_links)
 
 
 def update_metadata(overwrite=False):
@@ -64,14 +130,33 @@ def update_metadata(overwrite=False):
     for document in dm.Document.objects.all():
         try:
             if document.update_metadata_from_source_file(overwrite=overwrite):
-                document.save()
+                document.save_changed()
         except:  # Give them all a go
             pass
 
 
-def import_metadata(excel_filename):
-    importer = XLImporter(excel_filename)
-    importer.load()
+def import_metadata(excel_filename, streaming=False, force=False, staged=False, processes=1):
+    """
+    Load document metadata from the CCCS spreadsheet
+    :param excel_filename: spreadsheet file name (or the sheet exported as .csv/.tsv which is much faster to read)
+    :param streaming: if True the sheet is read lazily in chunks so memory use is bounded
+    :param force: if True rows unchanged since the last import are loaded too
+    :param staged: if True the sheet is bulk loaded into staging tables and merged with set based SQL in one
+    transaction (fastest for large sheets)
+    :param processes: number of worker processes to load rows with (cannot be combined with staged)
+    :return: None
+    """
+    if staged and processes != 1:
+        raise ValueError('A staged import is a single transaction so cannot use multiple processes')
+    if os.path.splitext(excel_filename)[1].lower() in CSVImporter.extensions:
+        importer_class = CSVStagingImporter if staged else CSVImporter
+    else:
+        importer_class = StagingImporter if staged else XLImporter
+    importer = importer_class(excel_filename, streaming=streaming, force=force)
+    if processes == 1:
+        importer.load()
+    else:
+        load_parallel(importer, processes)
 
 
 def fix_significance(root_category_name='significance'):
@@ -79,26 +164,53 @@ def fix_significance(root_category_name='significance'):
     Make the short significance categories into tags on the related documents.
     Make the description significance categories the content of the significance field
     Remove all the significance categories
+    This is done with set based queries in one transaction and the significance subtree is deleted at once.
     :return: None
     """
-
-    # Add the short significance categories as tags and delete the catetories
     root = dm.DocumentCategory.objects.get(name=root_category_name)
-
     short_cat = dm.DocumentCategory.objects.get(name='short', parent=root)
-    for category in short_cat.children.all():
-        for document in category.documents.all():
-            document.tags.add(category.name)
-        category.delete()
-    short_cat.delete()
-
-    # Add the descriptions and delete the categories
     descriptive = dm.DocumentCategory.objects.get(name='descriptive', parent=root)
-    for category in descriptive.children.all():
-        for document in category.documents.all():
-            document.significance = category.name
-            document.save()
-        category.delete()
-    descriptive.delete()
+    through = dm.Document.categories.through
+
+    with transaction.atomic():
+        # Add the short significance categories as tags
+        RelationBatch.write_tag_links(set(through.objects.filter(documentcategory__parent=short_cat).values_list(
+            'document_id', 'documentcategory__name')))
+
+        # Add the descriptions
+        set_significance(descriptive)
+
+        # Remove all the significance categories
+        with dm.DocumentCategory.tree.disable_mptt_updates():
+            root.get_descendants(include_self=True).delete()
+        if root.parent_id is not None:  # close the gap in the rest of the tree
+            dm.DocumentCategory.tree.partial_rebuild(root.tree_id)
+            dm.recount_category_documents([root.tree_id])
+    cache.bump_version(cache.CATEGORY_TREE)
+    cache.bump_version(cache.DOCUMENT_MEMBERSHIP)
 
-    root.delete()
\ No newline at end of file
+
+def set_significance(descriptive):
+    """
+    Set the significance of the documents in the children of the descriptive category to the category name with
+    one UPDATE (a document in several of them gets the last in tree order)
+    :param descriptive: DocumentCategory
+    :return: None
+    """
+    qn = connection.ops.quote_name
+    categories_field = dm.Document._meta.get_field('categories')
+    significance = (
+        u'SELECT c.{name} FROM {through} t JOIN {category} c ON c.id = t.{category_column} '
+        u'WHERE t.{document_column} = {document}.id AND c.{parent} = %s'.format(
+            name=qn('name'), through=qn(categories_field.m2m_db_table()),
+            category=qn(dm.DocumentCategory._meta.db_table), category_column=qn(categories_field.m2m_reverse_name()),
+            document_column=qn(categories_field.m2m_column_name()), document=qn(dm.Document._meta.db_table),
+            parent=qn('parent_id')))
+    updated = dm.Document._meta.get_field('updated').get_db_prep_save(timezone.now(), connection)
+    cursor = connection.cursor()
+    cursor.execute(
+        u'UPDATE {document} SET {significance_column} = ({significance} ORDER BY c.lft DESC LIMIT 1), '
+        u'{updated} = %s WHERE EXISTS ({significance})'.format(
+            document=qn(dm.Document._meta.db_table), significance_column=qn('significance'),
+            significance=significance, updated=qn('updated')),
+        [descriptive.pk, updated, descriptive.pk])
\ No newline at end of file
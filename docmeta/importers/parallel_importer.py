@@ -0,0 +1,109 @@
+"""
+Multi-process spreadsheet import.
+The parent process reads the sheet and partitions the (document, row) pairs by document across worker processes, so
+each document is only ever written by one worker. Fuzzy matched named relations (entry types, distributions) are
+resolved by the parent so that every worker uses the same objects. Other relations shared between documents
+(authors, editors and tags) may be created concurrently; each worker commits them in short transactions of its own
+before loading a chunk and conflicts are resolved through their unique name constraints.
+"""
+import multiprocessing
+from Queue import Full
+
+from django.db import connections
+
+import docmeta.models as dm
+from docmeta.importers.excel_importer import chunked
+
+
+class ImportWorkerError(Exception):
+    pass
+
+
+def close_connections():
+    """
+    Forked processes must not share the parent's database connections; they reconnect as needed.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def run_worker(importer, work_queue):
+    while True:
+        work = work_queue.get()
+        if work is None:
+            break
+        resolved, work = work
+        importer.resolved_named_relations.update(resolved)
+        documents = dm.Document.objects.in_bulk(set(document_id for document_id, _ in work))
+        importer.load_document_rows((documents[document_id], row) for document_id, row in work
+                                    if document_id in documents)
+    close_connections()
+
+
+def put_work(worker, work_queue, work):
+    """
+    Queue work for worker, failing rather than blocking forever if the worker has died
+    """
+    while True:
+        try:
+            work_queue.put(work, timeout=1)
+            return
+        except Full:
+            if not worker.is_alive():
+                raise ImportWorkerError('Import worker {0} exited with {1}'.format(worker.name, worker.exitcode))
+
+
+def stop_workers(workers, work_queues):
+    """
+    Tell every live worker there is no more work and wait for them all to exit
+    """
+    for worker, work_queue in zip(workers, work_queues):
+        try:
+            put_work(worker, work_queue, None)
+        except ImportWorkerError:
+            pass  # already exited
+    for worker in workers:
+        worker.join()
+
+
+def load_parallel(importer, processes=None):
+    """
+    Load the importer's rows using processes worker processes (default one per cpu)
+    :param importer: XLImporter (or subclass) instance
+    :param processes: number of worker processes
+    :return: None
+    """
+    processes = processes or multiprocessing.cpu_count()
+    close_connections()  # before forking
+
+    work_queues = [multiprocessing.Queue(maxsize=4) for _ in range(processes)]
+    workers = [multiprocessing.Process(target=run_worker, args=(importer, work_queue))
+               for work_queue in work_queues]
+    for worker in workers:
+        worker.start()
+
+    try:
+        pending = [list() for _ in range(processes)]
+        resolutions = [dict() for _ in range(processes)]
+        for rows in chunked(importer.iter_rows(), importer.chunk_size):
+            # named relations are fuzzy matched here so every worker uses the same objects for similar names
+            resolved = importer.resolve_named_relations(rows)
+            for partition_resolutions in resolutions:
+                partition_resolutions.update(resolved)
+            for document, row in importer.iter_document_rows(rows):
+                partition = document.pk % processes
+                pending[partition].append((document.pk, row))
+                if len(pending[partition]) >= importer.chunk_size:
+                    put_work(workers[partition], work_queues[partition], (resolutions[partition], pending[partition]))
+                    pending[partition] = list()
+                    resolutions[partition] = dict(resolved)
+
+        for worker, work_queue, work, resolved in zip(workers, work_queues, pending, resolutions):
+            if work:
+                put_work(worker, work_queue, (resolved, work))
+    finally:  # even if the sheet or a worker failed, so the other workers don't wait for work forever
+        stop_workers(workers, work_queues)
+
+    failed = [worker for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise ImportWorkerError('{0} import workers failed'.format(len(failed)))
@@ -0,0 +1,175 @@
+"""
+Batched writing of document relations for bulk imports.
+Relations for a chunk of documents are collected and then written with a few set based queries rather than the
+two or three queries per relation that get_or_create() and add() need.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, OperationalError, transaction
+from django.contrib.contenttypes.models import ContentType
+from taggit.models import Tag, TaggedItem
+
+import docmeta.models as dm
+
+
+def in_batches(items, size=500):
+    """
+    Yield lists of up to size items (keeps IN clauses within database parameter limits)
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def normalize_name(value):
+    """
+    :return: the name for a cell value (cells may hold numbers) as it is collected and looked up
+    """
+    return unicode(value).strip()
+
+
+def find_named_ids(model, names):
+    """
+    :param names: normalized names
+    :return: {name: id} for the names that exist. A name the database matched to a row named differently (by a case
+    insensitive or pad space collation) maps to that row.
+    """
+    rows = list()
+    for batch in in_batches(names):
+        rows.extend(model.objects.filter(name__in=batch).values_list('name', 'id'))
+    exact = dict((normalize_name(name), pk) for name, pk in rows)
+    folded = dict((normalize_name(name).lower(), pk) for name, pk in rows)
+    ids = dict()
+    for name in names:
+        if name in exact:
+            ids[name] = exact[name]
+        elif name.lower() in folded:
+            ids[name] = folded[name.lower()]
+    return ids
+
+
+def create_named(model, name):
+    """
+    Create the named model object. Safe against a concurrent import creating the same name: the unique constraint
+    conflict is resolved by using the other import's object.
+    """
+    try:
+        with transaction.atomic():
+            return model.objects.create(name=name)
+    except IntegrityError:
+        return model.objects.get(name=name)
+
+
+def create_missing_named(model, names, attempts=3):
+    """
+    Create the model objects for the names that don't exist yet, in a short transaction of their own, so concurrent
+    imports hold each other's unique name locks only briefly. Must be called outside of any transaction.
+    Names are inserted in sorted order so imports creating overlapping names wait on each other rather than
+    deadlocking; a deadlock (or other transient failure) is retried.
+    :param model: named model class (Tag objects are created one by one as Tag.save() makes the slug)
+    :param names: names of the objects
+    :param attempts: number of times to try creating the objects
+    :return: None
+    """
+    names = sorted(set(names))
+    for attempt in range(attempts):
+        try:
+            existing = find_named_ids(model, names)
+            missing = [name for name in names if name not in existing]
+            if model is Tag:
+                for name in missing:
+                    create_named(model, name)
+            elif missing:
+                try:
+                    with transaction.atomic():
+                        model.objects.bulk_create([model(name=name) for name in missing])
+                except IntegrityError:  # a concurrent import created some of them
+                    for name in missing:
+                        create_named(model, name)
+            return
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+
+
+class RelationBatch(object):
+    """
+    Collects named m2m relations and tags for documents and writes them in bulk on flush().
+    Missing named objects are created with one bulk_create per model and only the through table rows that do not
+    already exist are inserted.
+    """
+    def __init__(self):
+        super(RelationBatch, self).__init__()
+        self.links = defaultdict(set)  # (field, model): set((document_id, normalized name))
+        self.tag_links = set()  # set((document_id, normalized tag_name))
+
+    def add_named(self, document, field, model, name):
+        name = normalize_name(name)
+        if name:
+            self.links[(field, model)].add((document.pk, name))
+
+    def add_tags(self, document, tag_names):
+        for tag_name in tag_names:
+            tag_name = normalize_name(tag_name)
+            if tag_name:
+                self.tag_links.add((document.pk, tag_name))
+
+    def flush(self):
+        for (field, model), links in self.links.items():
+            self.write_named_links(field, model, links)
+        self.write_tag_links(self.tag_links)
+        self.links.clear()
+        self.tag_links.clear()
+
+    @staticmethod
+    def get_or_create_named(model, names):
+        """
+        :param names: normalized names
+        :return: {name: id} for names, bulk creating the missing model objects
+        """
+        ids = find_named_ids(model, names)
+        missing = [name for name in names if name not in ids]
+        if missing:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([model(name=name) for name in missing])
+            except IntegrityError:  # a concurrent import created some of them
+                for name in missing:
+                    create_named(model, name)
+            ids.update(find_named_ids(model, missing))
+        return ids
+
+    def write_named_links(self, field, model, links):
+        ids = self.get_or_create_named(model, set(name for _, name in links))
+
+        m2m_field = dm.Document._meta.get_field(field)
+        through = m2m_field.rel.through
+        source_column = '{0}_id'.format(m2m_field.m2m_field_name())
+        target_column = '{0}_id'.format(m2m_field.m2m_reverse_field_name())
+
+        wanted = set((document_id, ids[name]) for document_id, name in links)
+        existing = set()
+        for batch in in_batches(set(document_id for document_id, _ in wanted)):
+            existing.update(through.objects.filter(**{'{0}__in'.format(source_column): batch})
+                                           .values_list(source_column, target_column))
+        through.objects.bulk_create([through(**{source_column: document_id, target_column: target_id})
+                                     for document_id, target_id in wanted - existing])
+
+    @staticmethod
+    def write_tag_links(tag_links):
+        if not tag_links:
+            return
+        tag_links = set((document_id, normalize_name(tag_name)) for document_id, tag_name in tag_links)
+        tag_names = set(tag_name for _, tag_name in tag_links)
+        tags = find_named_ids(Tag, tag_names)
+        for tag_name in tag_names - set(tags):
+            tags[tag_name] = create_named(Tag, tag_name).id  # Tag.save() makes the slug unique
+
+        content_type = ContentType.objects.get_for_model(dm.Document)
+        wanted = set((document_id, tags[tag_name]) for document_id, tag_name in tag_links)
+        existing = set()
+        for batch in in_batches(set(document_id for document_id, _ in wanted)):
+            existing.update(TaggedItem.objects.filter(content_type=content_type, object_id__in=batch)
+                                              .values_list('object_id', 'tag_id'))
+        TaggedItem.objects.bulk_create([TaggedItem(content_type=content_type, object_id=document_id, tag_id=tag_id)
+                                        for document_id, tag_id in wanted - existing])
@@ -0,0 +1,233 @@
+"""
+Spreadsheet import through staging tables.
+The XLImporter transforms are applied to each row in memory and the results are bulk loaded into temporary staging
+tables. Documents and their relations are then updated from the staging tables with a few set based statements in a
+single transaction.
+"""
+from django.db import connection, transaction
+from django.db.models import ForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from taggit.models import Tag, TaggedItem
+
+import docmeta.models as dm
+from docmeta import cache
+from docmeta.importers.excel_importer import XLImporter, chunked
+from docmeta.importers.relation_batch import normalize_name
+
+
+class StagedDocument(object):
+    """
+    Stand in for a document that records the field values assigned to it by the transforms.
+    Unassigned fields read as None.
+    """
+    def __init__(self, pk):
+        self.__dict__['pk'] = pk
+        self.__dict__['values'] = dict()
+
+    def __getattr__(self, name):
+        return self.values.get(name)
+
+    def __setattr__(self, name, value):
+        self.values[name] = value
+
+
+class StagingImporter(XLImporter):
+    """
+    XLImporter that merges the sheet into the database with set based SQL.
+    Document descriptions are not regenerated from changed content as they would be by Document.save().
+    """
+    stage_table = 'docmeta_import_stage'
+    merge_table = 'docmeta_import_stage_merge'
+    relation_stage_table = 'docmeta_import_stage_relation'
+
+    # document fields set by transforms that don't name their field in the column_spec kwargs
+    transform_fields = {
+        'fk_receiver': ('receiver',),
+        'publication_date': ('year', 'month', 'day')}
+
+    def __init__(self, *args, **kwargs):
+        super(StagingImporter, self).__init__(*args, **kwargs)
+        self.staged_fields = self.get_staged_fields()
+        self.staged_row_count = 0
+        self.staged_relations = list()  # (document_id, field, name) awaiting staging
+
+    def get_staged_fields(self):
+        """
+        :return: the concrete document fields that the scalar transforms of column_specs assign
+        """
+        field_names = set()
+        for _, suffix, kwargs in self.column_specs:
+            if suffix is not None:
+                field_names.update(self.transform_fields.get(suffix, (kwargs.get('field'),)))
+        fields = [field for field in dm.Document._meta.fields if field.name in field_names]
+        return sorted(fields, key=lambda field: field.column)
+
+    def load(self):
+        new_fingerprints = dict()
+        with transaction.atomic():  # the whole sheet is applied (or not) at once
+            cursor = connection.cursor()
+            self.create_stage_tables(cursor)
+            for chunk in chunked(self.iter_rows(), self.chunk_size):
+                self.stage_rows(cursor, chunk, new_fingerprints)
+            self.merge_documents(cursor)
+            self.merge_named_relations(cursor)
+            self.merge_tags(cursor)
+            self.save_fingerprints(new_fingerprints)
+            self.drop_stage_tables(cursor)
+        cache.bump_version(cache.DOCUMENT_MEMBERSHIP)  # documents were updated without post_save
+
+    def create_stage_tables(self, cursor):
+        qn = connection.ops.quote_name
+        self.drop_stage_tables(cursor)
+        columns = [u'{0} {1} NULL'.format(qn(field.column), field.db_type(connection))
+                   for field in self.staged_fields]
+        cursor.execute(u'CREATE TEMPORARY TABLE {0} ({1} integer NOT NULL, document_id integer NOT NULL, '
+                       u'{2})'.format(qn(self.stage_table), qn('row_number'), u', '.join(columns)))
+        cursor.execute(u'CREATE TEMPORARY TABLE {0} (document_id integer NOT NULL PRIMARY KEY, {1})'.format(
+            qn(self.merge_table), u', '.join(columns)))
+        cursor.execute(u'CREATE TEMPORARY TABLE {0} (document_id integer NOT NULL, field varchar(64) NOT NULL, '
+                       u'name varchar(512) NOT NULL)'.format(qn(self.relation_stage_table)))
+
+    def drop_stage_tables(self, cursor):
+        qn = connection.ops.quote_name
+        for table in (self.stage_table, self.merge_table, self.relation_stage_table):
+            cursor.execute(u'DROP TABLE IF EXISTS {0}'.format(qn(table)))
+
+    def stage_rows(self, cursor, rows, new_fingerprints):
+        """
+        Apply the transforms to each row and bulk insert the results into the staging tables
+        """
+        staged = list()
+        for document, row in self.iter_document_rows(rows):
+            self.staged_row_count += 1
+            fingerprint = self.row_fingerprint(row)
+            if self.is_unchanged(document, fingerprint):
+                continue
+            staged_document = StagedDocument(document.pk)
+            self.apply_transforms(staged_document, row)
+            staged.append([self.staged_row_count, document.pk] +
+                          [self.get_staged_value(field, staged_document) for field in self.staged_fields])
+            self.loaded_document_ids.add(document.pk)
+            new_fingerprints[document.pk] = fingerprint
+
+        qn = connection.ops.quote_name
+        if staged:
+            columns = [qn('row_number'), u'document_id'] + [qn(field.column) for field in self.staged_fields]
+            cursor.executemany(u'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                qn(self.stage_table), u', '.join(columns), u', '.join([u'%s'] * len(columns))), staged)
+        if self.staged_relations:
+            cursor.executemany(u'INSERT INTO {0} (document_id, field, name) VALUES (%s, %s, %s)'.format(
+                qn(self.relation_stage_table)), self.staged_relations)
+            self.staged_relations = list()
+
+    @staticmethod
+    def get_staged_value(field, staged_document):
+        value = staged_document.values.get(field.name)
+        if value is not None and isinstance(field, ForeignKey):
+            value = value.pk
+        return field.get_db_prep_save(value, connection)
+
+    def merge_documents(self, cursor):
+        """
+        Update every staged document with one statement. For each field the value from the last staged row that
+        set it wins (as it would loading the rows in order); unset fields keep their current values.
+        The winning values are first collected in the merge table (one statement per field) so that no statement
+        refers to a temporary table more than once, which MySQL does not allow.
+        """
+        qn = connection.ops.quote_name
+        document_table = qn(dm.Document._meta.db_table)
+        stage_table = qn(self.stage_table)
+        merge_table = qn(self.merge_table)
+        cursor.execute(u'INSERT INTO {merge} (document_id) SELECT DISTINCT document_id FROM {stage}'.format(
+            merge=merge_table, stage=stage_table))
+        for field in self.staged_fields:
+            cursor.execute(
+                u'UPDATE {merge} SET {column} = (SELECT s.{column} FROM {stage} s '
+                u'WHERE s.document_id = {merge}.document_id AND s.{column} IS NOT NULL '
+                u'ORDER BY s.{row_number} DESC LIMIT 1)'.format(
+                    merge=merge_table, column=qn(field.column), stage=stage_table, row_number=qn('row_number')))
+
+        updated = dm.Document._meta.get_field('updated').get_db_prep_save(timezone.now(), connection)
+        if connection.vendor == 'mysql':
+            assignments = [u'd.{0} = COALESCE(m.{0}, d.{0})'.format(qn(field.column)) for field in self.staged_fields]
+            assignments.append(u'd.{0} = %s'.format(qn('updated')))
+            cursor.execute(u'UPDATE {document} d JOIN {merge} m ON m.document_id = d.id SET {assignments}'.format(
+                document=document_table, merge=merge_table, assignments=u', '.join(assignments)), [updated])
+        else:
+            assignments = [u'{column} = COALESCE((SELECT m.{column} FROM {merge} m '
+                           u'WHERE m.document_id = {document}.id), {column})'.format(
+                               column=qn(field.column), merge=merge_table, document=document_table)
+                           for field in self.staged_fields]
+            assignments.append(u'{0} = %s'.format(qn('updated')))
+            cursor.execute(u'UPDATE {document} SET {assignments} WHERE id IN (SELECT document_id FROM {merge})'.format(
+                document=document_table, assignments=u', '.join(assignments), merge=merge_table), [updated])
+
+    def merge_named_relations(self, cursor):
+        """
+        Create the missing named objects and add the missing through table rows for each m2m field
+        """
+        qn = connection.ops.quote_name
+        relation_stage_table = qn(self.relation_stage_table)
+        for field_name, model in set((kwargs['field'], kwargs['model'])
+                                     for _, suffix, kwargs in self.column_specs if suffix == 'm2m'):
+            m2m_field = dm.Document._meta.get_field(field_name)
+            through_table = qn(m2m_field.m2m_db_table())
+            source_column = qn(m2m_field.m2m_column_name())
+            target_column = qn(m2m_field.m2m_reverse_name())
+            model_table = qn(model._meta.db_table)
+
+            cursor.execute(
+                u'INSERT INTO {model} (name) SELECT DISTINCT r.name FROM {relations} r WHERE r.field = %s '
+                u'AND NOT EXISTS (SELECT 1 FROM {model} m WHERE m.name = r.name)'.format(
+                    model=model_table, relations=relation_stage_table), [field_name])
+            cursor.execute(
+                u'INSERT INTO {through} ({source}, {target}) SELECT DISTINCT r.document_id, m.id '
+                u'FROM {relations} r JOIN {model} m ON m.name = r.name WHERE r.field = %s '
+                u'AND NOT EXISTS (SELECT 1 FROM {through} t WHERE t.{source} = r.document_id AND t.{target} = m.id)'
+                .format(through=through_table, source=source_column, target=target_column, model=model_table,
+                        relations=relation_stage_table), [field_name])
+
+    def merge_tags(self, cursor):
+        """
+        Create the missing tags (through the ORM as Tag.save() makes unique slugs) and add the missing tagged items
+        """
+        qn = connection.ops.quote_name
+        relation_stage_table = qn(self.relation_stage_table)
+        tag_table = qn(Tag._meta.db_table)
+        cursor.execute(
+            u'SELECT DISTINCT r.name FROM {relations} r WHERE r.field = %s '
+            u'AND NOT EXISTS (SELECT 1 FROM {tags} t WHERE t.name = r.name)'.format(
+                relations=relation_stage_table, tags=tag_table), ['tags'])
+        for (tag_name,) in cursor.fetchall():
+            Tag.objects.create(name=tag_name)
+
+        content_type = ContentType.objects.get_for_model(dm.Document)
+        cursor.execute(
+            u'INSERT INTO {items} (tag_id, content_type_id, object_id) SELECT DISTINCT t.id, %s, r.document_id '
+            u'FROM {relations} r JOIN {tags} t ON t.name = r.name WHERE r.field = %s '
+            u'AND NOT EXISTS (SELECT 1 FROM {items} i WHERE i.tag_id = t.id AND i.content_type_id = %s '
+            u'AND i.object_id = r.document_id)'.format(
+                items=qn(TaggedItem._meta.db_table), relations=relation_stage_table, tags=tag_table),
+            [content_type.pk, 'tags', content_type.pk])
+
+    def transform_m2m(self, document, raw_name, field, model):
+        """
+        Stage the m2m named element for merging by merge_named_relations
+        :return: Boolean - True if document object has changed
+        """
+        name = normalize_name(raw_name)
+        if name:
+            self.staged_relations.append((document.pk, field, name))
+        return False
+
+    def transform_tag(self, document, raw_tag_string):
+        """
+        Stage the tags (separated in raw_tag_string by semi colons) for merging by merge_tags
+        :return: Boolean - True if document object has changed
+        """
+        for tag_name in unicode(raw_tag_string).split(';'):
+            tag_name = normalize_name(tag_name)
+            if tag_name:
+                self.staged_relations.append((document.pk, 'tags', tag_name))
+        return False
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+import docmeta.models as dm
+
+
+class Command(NoArgsCommand):
+    help = 'Recount the documents in each category, repairing the incrementally maintained counts'
+
+    def handle_noargs(self, **options):
+        dm.recount_category_documents()
@@ -2,14 +2,23 @@ import os
 import hashlib
 import re
 import datetime
-
-from django.db import models
+from bisect import bisect_right
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q, F
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User
+from django.utils.timezone import now
 
 from mezzanine.core.fields import RichTextField
 from mezzanine.core.models import Displayable, RichText, CONTENT_STATUS_DRAFT, CONTENT_STATUS_PUBLISHED
+from mezzanine.utils.html import strip_tags
+from mezzanine.utils.sites import current_site_id
 from taggit.managers import TaggableManager
 
 from storages.backends.s3boto import S3BotoStorage
@@ -23,6 +32,7 @@ from categories.base import (MPTTModel,
                              force_unicode)
 
 from docmeta.utils.extract_metadata import extract_metadata
+from docmeta import cache
 
 
 def sha1(f):
@@ -67,6 +77,11 @@ class DocumentCategory(MPTTModel):
     name = models.CharField(max_length=512, verbose_name=_('name'))
     slug = models.SlugField(max_length=512, verbose_name=_('slug'))
     active = models.BooleanField(default=True, verbose_name=_('active'))
+    slug_path = models.CharField(max_length=1024, db_index=True, editable=False, default='')  # slugs from the root
+    path_label = models.TextField(editable=False, default='')  # names from the root
+    # documents in the category and in the category and its descendants (counted once per category they are in)
+    document_count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_document_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = CategoryManager()
     tree = TreeManager()
@@ -80,20 +95,82 @@ class DocumentCategory(MPTTModel):
         if not self.slug:
             self.slug = slugify(SLUG_TRANSLITERATOR(self.name))[:50]
 
+        # renamed or moved categories must update the stored paths of their descendants
+        slug_path, path_label = self.get_paths()
+        paths_changed = self.pk is not None and (slug_path, path_label) != (self.slug_path, self.path_label)
+        self.slug_path, self.path_label = slug_path, path_label
+
+        # moved categories take their documents from the old ancestors' subtree counts to the new ones
+        old_ancestor_ids = None
+        if self.pk is not None:
+            stored = DocumentCategory.objects.filter(pk=self.pk).values_list('parent', flat=True)
+            if stored and stored[0] != self.parent_id:
+                old_ancestor_ids = self.get_stored_ancestor_ids()
+
         super(DocumentCategory, self).save(*args, **kwargs)
 
-        if not self.active:
-            for item in self.get_descendants():
-                if item.active != self.active:
-                    item.active = self.active
-                    item.save()
+        if old_ancestor_ids is not None:
+            self.move_subtree_document_count(old_ancestor_ids)
+
+        if paths_changed:
+            self.update_descendant_paths()
+
+        if not self.active:  # one UPDATE over the tree_id/lft/rght range rather than saving each descendant
+            if self.get_descendants().filter(active=True).update(active=False):
+                cache.bump_version(cache.CATEGORY_TREE)  # update() sends no post_save
+
+    def move_to(self, target, position='first-child'):
+        """
+        Moves made with move_to() (as by the tree editor) update the tree without save(), so the subtree counts and
+        the stored paths are updated here
+        """
+        old_ancestor_ids = self.get_stored_ancestor_ids()
+        super(DocumentCategory, self).move_to(target, position)
+        self.move_subtree_document_count(old_ancestor_ids)
+        self.slug_path, self.path_label = self.get_paths()
+        DocumentCategory.objects.filter(pk=self.pk).update(slug_path=self.slug_path, path_label=self.path_label)
+        self.update_descendant_paths()
+        cache.bump_version(cache.CATEGORY_TREE)  # update() sends no post_save
+
+    def get_stored_ancestor_ids(self):
+        """
+        :return: ids of the ancestors as stored in the database (before a move changes them)
+        """
+        tree_id, lft, rght = DocumentCategory.objects.filter(pk=self.pk).values_list('tree_id', 'lft', 'rght')[0]
+        return list(DocumentCategory.objects.filter(tree_id=tree_id, lft__lt=lft, rght__gt=rght).values_list(
+            'pk', flat=True))
+
+    def move_subtree_document_count(self, old_ancestor_ids):
+        """
+        Take the documents of this (moved) category and its descendants from the subtree counts of its old ancestors
+        and add them to those of its new ancestors
+        """
+        count = DocumentCategory.objects.filter(pk=self.pk).values_list('subtree_document_count', flat=True)[0]
+        if count:
+            DocumentCategory.objects.filter(pk__in=old_ancestor_ids).update(
+                subtree_document_count=F('subtree_document_count') - count)
+            self.get_ancestors().update(subtree_document_count=F('subtree_document_count') + count)
+
+    def delete(self, *args, **kwargs):
+        """
+        Take the documents of the category and its descendants out of its ancestors' subtree counts. This is done
+        before the delete because MPTTModel.delete() closes the tree gap (moving the ancestors' rght) before any
+        pre_delete signal is sent.
+        """
+        document_count = Document.categories.through.objects.filter(
+            documentcategory__tree_id=self.tree_id,
+            documentcategory__lft__gte=self.lft,
+            documentcategory__rght__lte=self.rght).count()
+        if document_count:
+            self.get_ancestors().update(subtree_document_count=F('subtree_document_count') - document_count)
+        super(DocumentCategory, self).delete(*args, **kwargs)
 
     def __unicode__(self):
-        ancestors = self.get_ancestors()
-        return '/'.join([force_unicode(i.name) for i in ancestors] + [self.name, ])
+        return self.path_label or self.get_paths()[1]  # unsaved categories have no path label yet
 
     class Meta:
         unique_together = ('parent', 'name')
+        index_together = (('tree_id', 'lft', 'rght'),)  # subtree range lookups
         ordering = ('tree_id', 'lft')
         verbose_name_plural = 'document categories'
 
@@ -101,16 +178,34 @@ class DocumentCategory(MPTTModel):
         order_insertion_by = 'name'
 
     def get_absolute_url(self):
-        return reverse("document-category", args=('/'.join(self.category_slugs),))
+        return reverse("document-category", args=(self.slug_path,))
 
     @property
     def category_slugs(self):
-        category_slugs = [self.slug]
+        return self.slug_path.split('/')
+
+    def get_paths(self):
+        """
+        :return: (slug path, path label) - the slugs and the names of the ancestors and this category joined by '/'
+        """
+        if self.parent_id is None:
+            return self.slug, force_unicode(self.name)
         parent = self.parent
-        while parent:
-            category_slugs.insert(0, parent.slug)
-            parent = parent.parent
-        return category_slugs
+        return (u'{0}/{1}'.format(parent.slug_path, self.slug),
+                u'{0}/{1}'.format(parent.path_label, force_unicode(self.name)))
+
+    def update_descendant_paths(self):
+        """
+        Recompute the stored paths of the descendants (after the name, slug or parent of this category changed)
+        """
+        paths = {self.pk: (self.slug_path, self.path_label)}
+        for category in self.get_descendants():  # parents come before their children
+            parent_slug_path, parent_path_label = paths[category.parent_id]
+            slug_path = u'{0}/{1}'.format(parent_slug_path, category.slug)
+            path_label = u'{0}/{1}'.format(parent_path_label, category.name)
+            paths[category.pk] = (slug_path, path_label)
+            if (slug_path, path_label) != (category.slug_path, category.path_label):
+                DocumentCategory.objects.filter(pk=category.pk).update(slug_path=slug_path, path_label=path_label)
 
 
 class BibTexEntryType(UniqueNamed):
@@ -255,8 +350,11 @@ class Document(RichText, Displayable):
 
     search_fields = ("content", "title", "tags__name")
 
+    unique_name_attempts = 5  # saves of new documents racing for the same name
+
     class Meta:
         ordering = ('title',)
+        index_together = (('title', 'id'),)  # keyset pagination
 
     def get_absolute_url(self):
         return reverse("document-detail", args=(self.slug,))
@@ -265,10 +363,83 @@ class Document(RichText, Displayable):
     def tag_string(self):
         return ', '.join([tag.name for tag in self.tags.all()])
 
+    def __init__(self, *args, **kwargs):
+        super(Document, self).__init__(*args, **kwargs)
+        self.reset_changed_fields()
+
     def save(self, *args, **kwargs):
         if self.id is None:  # new
+            self.save_new(*args, **kwargs)
+        else:
+            super(Document, self).save(*args, **kwargs)
+        self.reset_changed_fields(kwargs.get('update_fields'))
+
+    def save_new(self, *args, **kwargs):
+        """
+        Save a new document with a unique name. If a concurrent save takes the name first the unique constraint
+        fails and the save is retried with the next free name.
+        """
+        for attempt in range(self.unique_name_attempts):
             self.unique_name()
-        super(Document, self).save(*args, **kwargs)
+            try:
+                with transaction.atomic():
+                    super(Document, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                if attempt == self.unique_name_attempts - 1:
+                    raise
+
+    def loaded_field_values(self):
+        """
+        :return: {field name: value} for the loaded concrete fields (deferred fields are left unloaded)
+        """
+        values = dict()
+        for field in self._meta.fields:
+            if field.primary_key or field.attname not in self.__dict__:
+                continue
+            value = self.__dict__[field.attname]
+            if isinstance(field, models.FileField):  # compare the file name rather than the (mutable) FieldFile
+                value = getattr(value, 'name', value)
+            values[field.name] = value
+        return values
+
+    def reset_changed_fields(self, field_names=None):
+        """
+        Treat the current values of field_names (default all fields) as unchanged.
+        """
+        values = self.loaded_field_values()
+        if field_names is None:
+            self._saved_field_values = values
+        else:
+            for field_name in field_names:
+                if field_name in values:
+                    self._saved_field_values[field_name] = values[field_name]
+
+    def changed_fields(self):
+        """
+        :return: names of the fields modified since the document was loaded or last saved
+        """
+        saved = self._saved_field_values
+        return [field_name for field_name, value in self.loaded_field_values().items()
+                if field_name not in saved or saved[field_name] != value]
+
+    def save_changed(self):
+        """
+        Save only the columns that have changed rather than rewriting every column (new documents are saved in full)
+        :return: Boolean - True if the document was saved
+        """
+        if self.id is None:
+            self.save()
+            return True
+
+        update_fields = self.changed_fields()
+        if not update_fields:
+            return False
+        update_fields.append('updated')  # maintained by save()
+        if self.gen_description:
+            update_fields.append('description')  # generated by save() from the content
+        self.save(update_fields=update_fields)
+        return True
 
     def update_metadata(self, overwrite=False):
         changed = False
@@ -347,19 +518,44 @@ Document._meta.get_field('title').verbose_name = 'Document / Article Title'
 class DocumentFileName(models.Model):
     document = models.ForeignKey(Document)
     name = models.CharField(max_length=512)
+    basename = models.CharField(max_length=512, db_index=True, editable=False)  # maintained from name
 
     class Meta:
         unique_together = ('document', 'name')
         ordering = ('document', 'name')
 
+    def save(self, *args, **kwargs):
+        self.basename = os.path.basename(self.name)
+        super(DocumentFileName, self).save(*args, **kwargs)
+
+
+class ImportRowFingerprint(models.Model):
+    """
+    Hash of the spreadsheet row last imported into a document from a source sheet.
+    Re-imports skip rows whose fingerprint is unchanged.
+    """
+    document = models.ForeignKey(Document)
+    source_sheet = models.CharField(max_length=256)
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = ('document', 'source_sheet')
+
 
 def categories_from_slugs(slugs):
-    parent = None
+    """
+    :param slugs: list of category slugs with root at the top
+    :return: list of the categories down the slugs (found with one query)
+    """
+    slug_paths = ['/'.join(slugs[:i + 1]) for i in range(len(slugs))]
+    categories = dict((category.slug_path, category)
+                      for category in DocumentCategory.objects.filter(slug_path__in=slug_paths))
     result = list()
-    for slug in slugs:
-        category = DocumentCategory.objects.get(slug=slug, parent=parent)
-        result.append(category)
-        parent = category
+    for slug_path in slug_paths:
+        try:
+            result.append(categories[slug_path])
+        except KeyError:
+            raise DocumentCategory.DoesNotExist(u'No category {0}'.format(slug_path))
     return result
 
 
@@ -389,19 +585,208 @@ def verify_categories(category_names, create_if_absent=False):
     return result
 
 
+class CategoryPathCache(object):
+    """
+    Import scoped map of category name paths (tuples with root at the top) to categories.
+    All existing categories are read in one query so resolving a path needs no further queries. Within
+    deferred_tree_updates() new categories do not renumber the tree as they are inserted; the affected trees are
+    rebuilt once at the end instead.
+    """
+    def __init__(self):
+        super(CategoryPathCache, self).__init__()
+        self.paths = dict()
+        self.modified_tree_ids = set()
+        self.next_tree_id = 1
+
+        paths_by_id = dict()
+        for category in DocumentCategory.objects.order_by('tree_id', 'lft'):  # parents come before their children
+            path = paths_by_id.get(category.parent_id, ()) + (category.name,)
+            paths_by_id[category.pk] = path
+            self.paths[path] = category
+            self.next_tree_id = max(self.next_tree_id, category.tree_id + 1)
+
+    def verify(self, category_names, create_if_absent=False):
+        """
+        As verify_categories but using (and maintaining) the cache
+        :param category_names: list of category names with root at the top
+        :return: list of the actual categories corresponding to the names.
+        """
+        parent = None
+        path = ()
+        result = list()
+        for category_name in category_names:
+            path += (category_name,)
+            try:
+                category = self.paths[path]
+            except KeyError:
+                if not create_if_absent:
+                    raise DocumentCategory.DoesNotExist(u'No category {0}'.format(u'/'.join(path)))
+                category = self.create_category(category_name, parent)
+                self.paths[path] = category
+            result.append(category)
+            parent = category
+        return result
+
+    def create_category(self, name, parent):
+        category = DocumentCategory(name=name, parent=parent)
+        category.save()
+        if parent is None and not DocumentCategory._mptt_updates_enabled:
+            # MPTT gives every root saved with updates disabled the same tree_id so allocate our own
+            category.tree_id = self.next_tree_id
+            self.next_tree_id += 1
+            DocumentCategory.objects.filter(pk=category.pk).update(tree_id=category.tree_id)
+        self.modified_tree_ids.add(category.tree_id)
+        return category
+
+    @contextmanager
+    def deferred_tree_updates(self):
+        """
+        Disable MPTT updates for the duration, rebuilding the modified trees once on exit (even on failure so that
+        the trees are never left inconsistent).
+        """
+        with DocumentCategory.tree.disable_mptt_updates():
+            try:
+                yield self
+            finally:
+                for tree_id in sorted(self.modified_tree_ids):
+                    DocumentCategory.tree.partial_rebuild(tree_id)
+                self.modified_tree_ids.clear()
+
+
 def get_root_categories():
     return DocumentCategory.tree.root_nodes()
 
 
+def get_category_tree(root=None):
+    """
+    Load the category tree (or the subtree below root) with one query and assemble it in memory. Each category's
+    children are cached so get_children() needs no query.
+    :param root: category whose descendants to load, by default all categories are loaded
+    :return: list of the top level categories (the roots or the children of root)
+    """
+    if root is None:
+        categories = DocumentCategory.objects.order_by('tree_id', 'lft')
+    else:
+        categories = root.get_descendants()
+
+    top_categories = list()
+    loaded = dict()
+    for category in categories:  # parents come before their children
+        category._cached_children = list()
+        parent = loaded.get(category.parent_id)
+        if parent is None:
+            top_categories.append(category)
+        else:
+            parent._cached_children.append(category)
+        loaded[category.pk] = category
+    return top_categories
+
+
 def get_orphan_documents():
     return Document.objects.filter(categories=None)
 
 
+def adjust_document_counts(category_counts):
+    """
+    Add to the document counts of categories and to the subtree document counts of them and their ancestors
+    :param category_counts: {category id: number of documents added to the category (negative if removed)}
+    :return: None
+    """
+    category_counts = dict((category_id, count) for category_id, count in category_counts.items() if count)
+    if not category_counts:
+        return
+    for category_id, tree_id, lft, rght in DocumentCategory.objects.filter(
+            pk__in=list(category_counts)).values_list('pk', 'tree_id', 'lft', 'rght'):
+        count = category_counts[category_id]
+        DocumentCategory.objects.filter(pk=category_id).update(document_count=F('document_count') + count)
+        DocumentCategory.objects.filter(tree_id=tree_id, lft__lte=lft, rght__gte=rght).update(
+            subtree_document_count=F('subtree_document_count') + count)
+    cache.bump_version(cache.CATEGORY_TREE)
+    cache.bump_version(cache.DOCUMENT_MEMBERSHIP)
+
+
+def refresh_category_paths(tree_ids=None):
+    """
+    Recompute the stored slug paths and path labels (after categories were moved or renamed by set based updates)
+    :param tree_ids: trees to refresh, by default all of them
+    :return: None
+    """
+    categories = DocumentCategory.objects.order_by('tree_id', 'lft')  # parents come before their children
+    if tree_ids is not None:
+        categories = categories.filter(tree_id__in=list(tree_ids))
+    paths = dict()
+    for pk, parent_id, slug, name, old_slug_path, old_path_label in categories.values_list(
+            'pk', 'parent', 'slug', 'name', 'slug_path', 'path_label'):
+        if parent_id is None:
+            slug_path, path_label = slug, name
+        else:
+            parent_slug_path, parent_path_label = paths[parent_id]
+            slug_path = u'{0}/{1}'.format(parent_slug_path, slug)
+            path_label = u'{0}/{1}'.format(parent_path_label, name)
+        paths[pk] = (slug_path, path_label)
+        if (slug_path, path_label) != (old_slug_path, old_path_label):
+            DocumentCategory.objects.filter(pk=pk).update(slug_path=slug_path, path_label=path_label)
+
+
+def recount_category_documents(tree_ids=None):
+    """
+    Recount the (incrementally maintained) document counts of the categories with a set based update, then sum the
+    subtree counts in memory (MySQL can't update a table from a subquery on the same table) and write the changed
+    ones with one update per tree
+    :param tree_ids: trees to recount, by default all of them
+    :return: None
+    """
+    qn = connection.ops.quote_name
+    category_table = qn(DocumentCategory._meta.db_table)
+    categories_field = Document._meta.get_field('categories')
+    where, params = u'', list()
+    if tree_ids is not None:
+        tree_ids = list(tree_ids)
+        if not tree_ids:
+            return
+        where = u' WHERE tree_id IN ({0})'.format(u', '.join([u'%s'] * len(tree_ids)))
+        params = tree_ids
+
+    cursor = connection.cursor()
+    cursor.execute(
+        u'UPDATE {category} SET document_count = (SELECT COUNT(*) FROM {through} t '
+        u'WHERE t.{target} = {category}.id){where}'.format(
+            category=category_table, through=qn(categories_field.m2m_db_table()),
+            target=qn(categories_field.m2m_reverse_name()), where=where), params)
+
+    categories = DocumentCategory.objects.order_by('tree_id', 'lft')
+    if tree_ids is not None:
+        categories = categories.filter(tree_id__in=tree_ids)
+    trees = dict()  # tree id: [(lft, rght, pk, document count, subtree document count)] in lft order
+    for row in categories.values_list('tree_id', 'lft', 'rght', 'pk', 'document_count', 'subtree_document_count'):
+        trees.setdefault(row[0], list()).append(row[1:])
+    for rows in trees.values():
+        lfts = [row[0] for row in rows]
+        totals = [0]  # totals[i] is the document count of the first i categories (a subtree is a run of them)
+        for row in rows:
+            totals.append(totals[-1] + row[3])
+        changed = list()
+        for i, (lft, rght, pk, _, subtree_document_count) in enumerate(rows):
+            count = totals[bisect_right(lfts, rght)] - totals[i]
+            if count != subtree_document_count:
+                changed.append((pk, count))
+        for start in range(0, len(changed), 300):  # keeps the parameters within database limits
+            batch = changed[start:start + 300]
+            cursor.execute(
+                u'UPDATE {category} SET subtree_document_count = CASE id {cases} END WHERE id IN ({ids})'.format(
+                    category=category_table, cases=u' '.join([u'WHEN %s THEN %s'] * len(batch)),
+                    ids=u', '.join([u'%s'] * len(batch))),
+                [value for pk_count in batch for value in pk_count] + [pk for pk, _ in batch])
+    cache.bump_version(cache.CATEGORY_TREE)
+    cache.bump_version(cache.DOCUMENT_MEMBERSHIP)
+
+
 def get_unique_title(title):
     """
     Return unique version of title, altering it if necessary by adding (or incrementing) a suffixed integer in
-    brackets. For example, if the matching title 'About' already exists, return 'About (1)' Altered titles will
-    result in numbers being re-used. This is done as a function because it is also used in migration
+    brackets. For example, if the matching title 'About' already exists, return 'About (1)'. The number used is one
+    more than the highest existing one, so gaps left by deleted or renamed titles are not filled. This is done as a
+    function because it is also used in migration
     """
     return get_unique_field_value(title, Document.objects, 'title')
 
@@ -425,19 +810,161 @@ def get_unique_field_value(candidate, object_manager, field_name):
     """
     Return unique version of field_name candidate, altering it if necessary by adding (or incrementing) a suffixed
     integer in brackets. For example, if the matching candidate 'About' already exists, return 'About (1)'.
+    The candidate and its numbered versions are read with one (prefix) query and the number after the highest
+    existing one is used.
     """
     pat = re.compile(r'(.*\()(\d+)(\))$')  # (prefix, existing_num, suffix) if successful
 
-    def generate_new_candidate(candidate):
-        match = re.match(pat, candidate)
-        if match:  # already has a number so increment it
-            num = int(match.groups()[1]) + 1
-            new_candidate = match.groups()[0] + str(num) + match.groups()[2]
-        else:  # Add the first incremental number
-            new_candidate = "{0} (1)".format(candidate)
-        return new_candidate
+    match = re.match(pat, candidate)
+    if match:  # already has a number so increment it
+        prefix, num = match.groups()[0], int(match.groups()[1]) + 1
+    else:  # Add the first incremental number
+        prefix, num = u'{0} ('.format(candidate), 1
+
+    existing = object_manager.filter(Q(**{field_name: candidate}) |
+                                     Q(**{'{0}__startswith'.format(field_name): prefix}))
+    existing = set(existing.values_list(field_name, flat=True))
+    if candidate not in existing:
+        return candidate
+
+    numbered_pat = re.compile(re.escape(prefix) + r'(\d+)\)$')
+    for value in existing:
+        numbered_match = re.match(numbered_pat, value)
+        if numbered_match:
+            num = max(num, int(numbered_match.group(1)) + 1)
+    return u'{0}{1})'.format(prefix, num)
+
+
+class UniqueValueAllocator(object):
+    """
+    Allocate unique values of a field in memory for batches of new objects (e.g. to be bulk created).
+    The existing values that could collide with a batch of candidates are read with one query per batch_size
+    candidates; values allocated earlier are remembered so later batches don't reuse them.
+    """
+    batch_size = 200  # candidates per query
+
+    def __init__(self, object_manager, field_name, template=u'{0} ({1})'):
+        """
+        :param object_manager: manager of the objects that must not collide
+        :param field_name: name of the unique field
+        :param template: format of the numbered version of a value ({0}) with number ({1})
+        """
+        super(UniqueValueAllocator, self).__init__()
+        self.object_manager = object_manager
+        self.field_name = field_name
+        self.template = template
+        self.prefix_template = template[:template.index('{1}')]
+        self.taken = set()
+        self.read_candidates = set()
+        self.next_numbers = dict()  # candidate: next number to try
+
+    def read_taken(self, candidates):
+        """
+        Read the existing values equal to candidates or numbered versions of them
+        """
+        candidates = list(candidates)
+        startswith = '{0}__startswith'.format(self.field_name)
+        for i in range(0, len(candidates), self.batch_size):
+            batch = candidates[i:i + self.batch_size]
+            query = Q(**{'{0}__in'.format(self.field_name): batch})
+            for candidate in batch:
+                query |= Q(**{startswith: self.prefix_template.format(candidate)})
+            self.taken.update(self.object_manager.filter(query).values_list(self.field_name, flat=True))
+        self.read_candidates.update(candidates)
+
+    def allocate(self, candidates):
+        """
+        :param candidates: wanted values
+        :return: list of unique values for candidates (in the same order)
+        """
+        candidates = list(candidates)
+        self.read_taken(set(candidates) - self.read_candidates)
+
+        values = list()
+        for candidate in candidates:
+            value = candidate
+            while value in self.taken:
+                number = self.next_numbers.get(candidate, 1)
+                self.next_numbers[candidate] = number + 1
+                value = self.template.format(candidate, number)
+            self.taken.add(value)
+            values.append(value)
+        return values
+
+
+def prepare_new_documents(documents, name_allocator, slug_allocator):
+    """
+    Set the fields that Document.save() sets for new documents so that they can be bulk created.
+    :param documents: new Document objects with a name or title
+    :param name_allocator: UniqueValueAllocator of Document names
+    :param slug_allocator: UniqueValueAllocator of Document slugs (template u'{0}-{1}' like mezzanine's slugs)
+    :return: None
+    """
+    names = name_allocator.allocate(document.name or document.title for document in documents)
+    unslugged = [document for document in documents if not document.slug]
+    for document, slug in zip(unslugged, slug_allocator.allocate(document.get_slug() for document in unslugged)):
+        document.slug = slug
+
+    site_id = current_site_id()
+    created = now()
+    for document, name in zip(documents, names):
+        document.name = name
+        if document.site_id is None:
+            document.site_id = site_id
+        document.created = document.updated = created
+        if document.publish_date is None:
+            document.publish_date = created
+        if document.gen_description:
+            document.description = strip_tags(document.description_from_content())
+
+
+@receiver(post_save, sender=DocumentCategory)
+@receiver(post_delete, sender=DocumentCategory)
+def category_changed(sender, **kwargs):
+    cache.bump_version(cache.CATEGORY_TREE)
+
+
+@receiver(m2m_changed, sender=Document.categories.through)
+def document_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Maintain the category document counts as documents are added to and removed from categories
+    """
+    if action in ('pre_remove', 'pre_clear'):
+        # capture the links actually removed (pk_set may include objects that aren't linked)
+        if reverse:  # instance is a category
+            links = sender.objects.filter(documentcategory=instance)
+            if pk_set is not None:
+                links = links.filter(document__in=pk_set)
+        else:
+            links = sender.objects.filter(document=instance)
+            if pk_set is not None:
+                links = links.filter(documentcategory__in=pk_set)
+        instance._removed_category_ids = list(links.values_list('documentcategory_id', flat=True))
+    elif action in ('post_remove', 'post_clear'):
+        removed = Counter(getattr(instance, '_removed_category_ids', ()))
+        adjust_document_counts(dict((category_id, -count) for category_id, count in removed.items()))
+        instance._removed_category_ids = ()
+    elif action == 'post_add' and pk_set:  # pk_set only has the newly linked objects
+        adjust_document_counts({instance.pk: len(pk_set)} if reverse else dict.fromkeys(pk_set, 1))
+
+
+@receiver(pre_delete, sender=Document)
+def document_deleted(sender, instance, **kwargs):
+    category_ids = Document.categories.through.objects.filter(document=instance).values_list(
+        'documentcategory_id', flat=True)
+    adjust_document_counts(dict.fromkeys(category_ids, -1))
+
+
+@receiver(pre_delete, sender=DocumentCategory)
+def category_deleted(sender, instance, **kwargs):
+    """
+    Documents of a deleted category may become orphans (the subtree counts are adjusted by DocumentCategory.delete())
+    """
+    if Document.categories.through.objects.filter(documentcategory=instance).exists():
+        cache.bump_version(cache.DOCUMENT_MEMBERSHIP)
 
-    while object_manager.filter(**{field_name: candidate}):  # any matches
-        candidate = generate_new_candidate(candidate)
 
-    return candidate
\ No newline at end of file
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def document_changed(sender, **kwargs):
+    cache.bump_version(cache.DOCUMENT_MEMBERSHIP)
@@ -10,15 +10,56 @@ $(function () {
         .removeClass('fa-folder-open-o')
         .addClass('fa-folder');
 
-    // Add open/close behaviour to all parent_li
-    $('.tree li.parent_li > span').on('click', function (e) {
-        var children = $(this).parent('li.parent_li').find(' > ul > li');
+    function toggle(span) {
+        var children = span.parent('li.parent_li').find(' > ul > li');
         if (children.is(":visible")) {
             children.hide('fast');
-            $(this).attr('title', 'Expand this branch').find(' > i').addClass('fa-folder').removeClass('fa-folder-open');
+            span.attr('title', 'Expand this branch').find(' > i').addClass('fa-folder').removeClass('fa-folder-open');
         } else {
             children.show('fast');
-            $(this).attr('title', 'Collapse this branch').find(' > i').addClass('fa-folder-open').removeClass('fa-folder');
+            span.attr('title', 'Collapse this branch').find(' > i').addClass('fa-folder-open').removeClass('fa-folder');
+        }
+    }
+
+    // Lazy trees only render the top level: a node with data-children-url fetches its children when first expanded
+    function lazyNode(category) {
+        var li = $('<li style="display: none;"></li>');
+        var span = $('<span><i class="fa fa-folder-open-o"></i></span>');
+        li.append(span)
+            .append(' ')
+            .append($('<a></a>').attr('href', category.url).text(category.label));
+        if (category.subtree_document_count !== undefined) {  // counts are only sent to staff
+            li.append(' ')
+                .append($('<span class="badge"></span>')
+                    .attr('title', category.document_count + ' in this category')
+                    .text(category.subtree_document_count));
+        }
+        if (category.children_url) {
+            li.addClass('parent_li').attr('data-children-url', category.children_url);
+            span.attr('title', 'Expand this branch').find('> i').removeClass('fa-folder-open-o').addClass('fa-folder');
+        }
+        return li;
+    }
+
+    // Add open/close behaviour to all parent_li (delegated so it applies to lazily added nodes too)
+    $('.tree').on('click', 'li.parent_li > span', function (e) {
+        var span = $(this);
+        var li = span.parent('li.parent_li');
+        var childrenUrl = li.attr('data-children-url');
+        if (childrenUrl && !li.data('loaded')) {
+            li.data('loaded', true);
+            $.getJSON(childrenUrl, function (data) {
+                var ul = $('<ul></ul>');
+                $.each(data.children, function (idx, category) {
+                    ul.append(lazyNode(category));
+                });
+                li.append(ul);
+                toggle(span);
+            }).fail(function () {
+                li.data('loaded', false);
+            });
+        } else {
+            toggle(span);
         }
         e.stopPropagation();
     });
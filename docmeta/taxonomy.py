@@ -0,0 +1,137 @@
+"""
+Bulk reorganization of the category taxonomy.
+Categories are moved and document memberships reassigned with set based updates while MPTT updates are disabled.
+Each affected tree is then rebuilt once (rather than renumbered for every node moved) and the stored paths and
+document counts of its categories refreshed.
+"""
+from django.db import connection, transaction
+from django.db.models import Max
+
+import docmeta.models as dm
+from docmeta import cache
+
+
+class TaxonomyError(Exception):
+    pass
+
+
+def rebuild_trees(tree_ids):
+    """
+    Rebuild the MPTT fields of the trees then refresh their category paths and document counts
+    :param tree_ids: trees to rebuild
+    :return: None
+    """
+    for tree_id in sorted(tree_ids):
+        dm.DocumentCategory.tree.partial_rebuild(tree_id)
+    dm.refresh_category_paths(tree_ids)
+    dm.recount_category_documents(tree_ids)
+    cache.bump_version(cache.CATEGORY_TREE)
+
+
+def check_acyclic(tree_ids):
+    """
+    :raise: TaxonomyError if a category in the trees has become its own ancestor
+    """
+    parents = dict(dm.DocumentCategory.objects.filter(tree_id__in=list(tree_ids)).values_list('pk', 'parent'))
+    for pk in parents:
+        seen = set()
+        while pk is not None:
+            if pk in seen:
+                raise TaxonomyError(u'Category {0} would be its own ancestor'.format(pk))
+            seen.add(pk)
+            pk = parents.get(pk)
+
+
+def move_categories(moves):
+    """
+    Move categories, with their subtrees, to new parents
+    :param moves: sequence of (category, new parent) pairs; a new parent of None makes the category a root
+    :return: None
+    """
+    moves = list(moves)
+    tree_ids = set()
+    next_tree_id = None
+    with transaction.atomic():
+        with dm.DocumentCategory.tree.disable_mptt_updates():
+            for category, parent in moves:
+                tree_ids.add(category.tree_id)
+                if parent is None:
+                    if category.parent_id is None:
+                        continue  # already a root
+                    # new roots get a tree of their own (as CategoryPathCache does) so only affected trees are rebuilt
+                    if next_tree_id is None:
+                        next_tree_id = dm.DocumentCategory.objects.aggregate(Max('tree_id'))['tree_id__max'] + 1
+                    dm.DocumentCategory.objects.filter(pk=category.pk).update(parent=None, tree_id=next_tree_id)
+                    tree_ids.add(next_tree_id)
+                    next_tree_id += 1
+                else:
+                    tree_ids.add(parent.tree_id)
+                    dm.DocumentCategory.objects.filter(pk=category.pk).update(parent=parent)
+            check_acyclic(tree_ids)
+        rebuild_trees(tree_ids)
+
+
+def reassign_documents(source_ids, target_id):
+    """
+    Link the documents of the source categories to the target category (once each) and unlink them from the
+    sources with two statements
+    """
+    qn = connection.ops.quote_name
+    categories_field = dm.Document._meta.get_field('categories')
+    names = {
+        'through': qn(categories_field.m2m_db_table()),
+        'document': qn(categories_field.m2m_column_name()),
+        'category': qn(categories_field.m2m_reverse_name()),
+        'sources': u', '.join([u'%s'] * len(source_ids))}
+    cursor = connection.cursor()
+    cursor.execute(
+        u'INSERT INTO {through} ({document}, {category}) SELECT DISTINCT t.{document}, %s FROM {through} t '
+        u'WHERE t.{category} IN ({sources}) AND NOT EXISTS (SELECT 1 FROM {through} e '
+        u'WHERE e.{document} = t.{document} AND e.{category} = %s)'.format(**names),
+        [target_id] + list(source_ids) + [target_id])
+    cursor.execute(u'DELETE FROM {through} WHERE {category} IN ({sources})'.format(**names), list(source_ids))
+
+
+def merge_into(sources, target, tree_ids):
+    """
+    Move the documents and children of sources to target and delete sources. Children named like one of target's
+    children are merged into it.
+    """
+    source_ids = [source.pk for source in sources]
+    tree_ids.update(source.tree_id for source in sources)
+    reassign_documents(source_ids, target.pk)
+
+    target_children = dict((child.name, child) for child in dm.DocumentCategory.objects.filter(parent=target))
+    merges = dict()  # target child: source children to merge into it
+    for child in dm.DocumentCategory.objects.filter(parent__in=source_ids):
+        if child.name in target_children:
+            merges.setdefault(target_children[child.name], list()).append(child)
+        else:
+            dm.DocumentCategory.objects.filter(pk=child.pk).update(parent=target)
+            target_children[child.name] = child
+    for target_child, children in merges.items():
+        merge_into(children, target_child, tree_ids)
+
+    dm.DocumentCategory.objects.filter(pk__in=source_ids).delete()
+
+
+def merge_categories(sources, target):
+    """
+    Merge categories into target: their documents and subcategories move to target and they are deleted.
+    Subcategories with the same name as one of target's subcategories are merged into it.
+    :param sources: categories to merge
+    :param target: category to merge them into
+    :return: None
+    """
+    sources = [source for source in sources if source.pk != target.pk]
+    for source in sources:
+        if source.tree_id == target.tree_id and source.lft < target.lft and target.rght < source.rght:
+            raise TaxonomyError(u'Cannot merge {0} into its descendant {1}'.format(source, target))
+    if not sources:
+        return
+
+    tree_ids = set([target.tree_id])
+    with transaction.atomic():
+        with dm.DocumentCategory.tree.disable_mptt_updates():
+            merge_into(sources, target, tree_ids)
+        rebuild_trees(tree_ids)
@@ -1,3 +1,89 @@
 from django.test import TestCase
 
-# Create your tests here.
+import docmeta.models as dm
+
+
+class UniqueFieldValueTest(TestCase):
+    def create_authors(self, *names):
+        for name in names:
+            dm.Author.objects.create(name=name)
+
+    def get_unique_name(self, candidate):
+        return dm.get_unique_field_value(candidate, dm.Author.objects, 'name')
+
+    def test_unused_candidate(self):
+        self.create_authors(u'Title (1)')
+        self.assertEqual(self.get_unique_name(u'Title'), u'Title')
+
+    def test_first_number(self):
+        self.create_authors(u'Title')
+        self.assertEqual(self.get_unique_name(u'Title'), u'Title (1)')
+
+    def test_gaps_are_not_filled(self):
+        self.create_authors(u'Title', u'Title (1)', u'Title (3)')
+        self.assertEqual(self.get_unique_name(u'Title'), u'Title (4)')
+
+    def test_numbers_compare_numerically(self):
+        self.create_authors(u'Title', u'Title (9)', u'Title (10)')
+        self.assertEqual(self.get_unique_name(u'Title'), u'Title (11)')
+
+    def test_prefix_collisions_are_ignored(self):
+        self.create_authors(u'Title', u'Title (2a)', u'Title (2) b', u'Title (1)')
+        self.assertEqual(self.get_unique_name(u'Title'), u'Title (2)')
+
+    def test_numbered_candidate_is_incremented(self):
+        self.create_authors(u'Title (2)')
+        self.assertEqual(self.get_unique_name(u'Title (2)'), u'Title (3)')
+
+
+class UniqueValueAllocatorTest(TestCase):
+    def test_allocate(self):
+        for name in (u'Title', u'Title (1)', u'Other (1)'):
+            dm.Author.objects.create(name=name)
+        allocator = dm.UniqueValueAllocator(dm.Author.objects, 'name')
+        self.assertEqual(allocator.allocate([u'Title', u'Other', u'Title', u'New']),
+                         [u'Title (2)', u'Other', u'Title (3)', u'New'])
+        # values allocated by earlier batches are not reused
+        self.assertEqual(allocator.allocate([u'Other', u'New']), [u'Other (2)', u'New (1)'])
+
+    def test_slug_template(self):
+        dm.Author.objects.create(name=u'title')
+        allocator = dm.UniqueValueAllocator(dm.Author.objects, 'name', template=u'{0}-{1}')
+        self.assertEqual(allocator.allocate([u'title', u'title']), [u'title-1', u'title-2'])
+
+
+class CategoryDocumentCountTest(TestCase):
+    def test_delete_leaf_with_documents(self):
+        root = dm.DocumentCategory.objects.create(name=u'Root')
+        branch = dm.DocumentCategory.objects.create(name=u'Branch', parent=root)
+        leaf = dm.DocumentCategory.objects.create(name=u'Leaf', parent=branch)
+        for title in (u'First', u'Second'):
+            dm.Document.objects.create(title=title).categories.add(leaf)
+        root = dm.DocumentCategory.objects.get(pk=root.pk)
+        self.assertEqual(root.subtree_document_count, 2)
+
+        dm.DocumentCategory.objects.get(pk=leaf.pk).delete()
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=root.pk).subtree_document_count, 0)
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=branch.pk).subtree_document_count, 0)
+
+    def test_move_to_root(self):
+        root = dm.DocumentCategory.objects.create(name=u'Root')
+        leaf = dm.DocumentCategory.objects.create(name=u'Leaf', parent=root)
+        dm.Document.objects.create(title=u'First').categories.add(leaf)
+
+        leaf = dm.DocumentCategory.objects.get(pk=leaf.pk)
+        leaf.parent = None
+        leaf.save()
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=root.pk).subtree_document_count, 0)
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=leaf.pk).subtree_document_count, 1)
+
+    def test_move_to(self):
+        first = dm.DocumentCategory.objects.create(name=u'First')
+        second = dm.DocumentCategory.objects.create(name=u'Second')
+        leaf = dm.DocumentCategory.objects.create(name=u'Leaf', parent=first)
+        dm.Document.objects.create(title=u'First').categories.add(leaf)
+
+        dm.DocumentCategory.objects.get(pk=leaf.pk).move_to(dm.DocumentCategory.objects.get(pk=second.pk))
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=first.pk).subtree_document_count, 0)
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=second.pk).subtree_document_count, 1)
+        self.assertEqual(dm.DocumentCategory.objects.get(pk=leaf.pk).slug_path, u'second/leaf')
@@ -13,6 +13,8 @@ urlpatterns = patterns(
     url(r'^delete/(?P<pk>[\w]+)/$', login_required(views.DocumentDeleteView.as_view()), name='document-delete'),
     url(r'^category/$', views.RootCategoriesView.as_view(), name='document-category-root'),
     url(r'^category/(?P<category_slugs>[\w/-]+)/$', views.CategoryView.as_view(), name='document-category'),
+    url(r'^category-children/$', views.category_children, name='document-category-children-root'),
+    url(r'^category-children/(?P<pk>\d+)/$', views.category_children, name='document-category-children'),
     url(r'^detail/(?P<slug>[~\w_-]+)/$', views.DocumentDetailView.as_view(), name='document-detail'),
     url(r'^bibtex/$$', TemplateView.as_view(template_name='docmeta/document_bibtex.html'), name='document-bibtex'),
     url(r'^download/(?P<slug>[\w_-]+)/$', views.download, name='document-download'))
@@ -0,0 +1,53 @@
+import heapq
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+
+class TrigramIndex(object):
+    """
+    Index of strings by their character trigrams for close match lookups.
+    Only keys sharing trigrams with the word are considered (those sharing the most first) and they are scored with
+    the SequenceMatcher ratio used by difflib.get_close_matches, so a lookup does not scan every key.
+    """
+    def __init__(self, keys=(), cutoff=0.6, max_candidates=20):
+        """
+        :param keys: initial strings to index
+        :param cutoff: minimum SequenceMatcher ratio for a match (as for difflib.get_close_matches)
+        :param max_candidates: number of best trigram sharing keys that are scored
+        """
+        super(TrigramIndex, self).__init__()
+        self.cutoff = cutoff
+        self.max_candidates = max_candidates
+        self.postings = defaultdict(set)
+        for key in keys:
+            self.add(key)
+
+    @staticmethod
+    def trigrams(s):
+        padded = u'  {0} '.format(s)  # padding gives short strings trigrams and weights word starts
+        return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    def add(self, key):
+        for trigram in self.trigrams(key):
+            self.postings[trigram].add(key)
+
+    def get_close_match(self, word):
+        """
+        :return: the indexed key closest to word with a ratio of at least cutoff, or None
+        """
+        shared = defaultdict(int)
+        for trigram in self.trigrams(word):
+            for key in self.postings.get(trigram, ()):
+                shared[key] += 1
+
+        matcher = SequenceMatcher()
+        matcher.set_seq2(word)
+        best_key, best_ratio = None, self.cutoff
+        for key in heapq.nlargest(self.max_candidates, shared, key=shared.get):
+            matcher.set_seq1(key)
+            if (matcher.real_quick_ratio() >= best_ratio and
+                    matcher.quick_ratio() >= best_ratio):
+                ratio = matcher.ratio()
+                if ratio > best_ratio or (ratio == best_ratio and best_key is None):
+                    best_key, best_ratio = key, ratio
+        return best_key
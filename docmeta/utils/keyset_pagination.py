@@ -0,0 +1,128 @@
+import json
+import base64
+import operator
+
+from django.db import connections
+from django.db.models import Q
+
+
+def encode_cursor(values):
+    """
+    :return: url safe string for the key values of a row
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :return: the key values encoded in cursor
+    :raise: ValueError if cursor is not a valid cursor
+    """
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor {0!r}'.format(cursor))
+
+
+def keyset_filter(keys, cursor, lookup):
+    """
+    :param cursor: cursor of a row
+    :param lookup: 'gt' for the rows after the cursor or 'lt' for those before it (in keys order)
+    :return: Q for the rows whose keys are after/before those of the cursor
+    :raise: ValueError if cursor is not a valid cursor for keys
+    """
+    values = decode_cursor(cursor)
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError('Invalid cursor {0!r}'.format(cursor))
+    for key, value in zip(keys, values):
+        # only scalars can be query parameters and ids must be integers
+        valid_types = (int, long) if key in ('id', 'pk') else (basestring, int, long)
+        if isinstance(value, bool) or not isinstance(value, valid_types):
+            raise ValueError('Invalid cursor {0!r}'.format(cursor))
+    queries = list()
+    for i, key in enumerate(keys):
+        conditions = dict(zip(keys[:i], values[:i]))
+        conditions['{0}__{1}'.format(key, lookup)] = values[i]
+        queries.append(Q(**conditions))
+    return reduce(operator.or_, queries)
+
+
+def estimate_count(queryset, exact_below=1000):
+    """
+    Estimate the number of rows in queryset from the PostgreSQL planner rather than counting them. Small estimates
+    (and other databases) are counted exactly.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= exact_below:
+            return estimate
+    return queryset.count()
+
+
+class KeysetPage(object):
+    """
+    A page of rows found by key (e.g. title, id) from a cursor rather than by offset, so every page costs the same as
+    the first. The total count is estimated.
+    """
+    def __init__(self, queryset, object_list, keys, has_previous, has_next):
+        super(KeysetPage, self).__init__()
+        self.queryset = queryset
+        self.object_list = object_list
+        self.keys = keys
+        self.has_previous = has_previous
+        self.has_next = has_next
+        self._count = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = estimate_count(self.queryset)
+        return self._count
+
+    def cursor(self, obj):
+        return encode_cursor([getattr(obj, key) for key in self.keys])
+
+    @property
+    def next_cursor(self):
+        return self.cursor(self.object_list[-1]) if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return self.cursor(self.object_list[0]) if self.has_previous and self.object_list else None
+
+
+def keyset_paginate(queryset, after=None, before=None, per_page=25, keys=('title', 'id')):
+    """
+    :param queryset: rows to page through
+    :param after: cursor of the row before the page
+    :param before: cursor of the row after the page (ignored if after is given)
+    :param per_page: number of rows in a page
+    :param keys: fields ordering the rows uniquely (covered by an index)
+    :return: KeysetPage
+    :raise: ValueError if a cursor is invalid
+    """
+    keys = list(keys)
+    if after is not None:
+        rows = list(queryset.filter(keyset_filter(keys, after, 'gt')).order_by(*keys)[:per_page + 1])
+        return KeysetPage(queryset, rows[:per_page], keys, True, len(rows) > per_page)
+    if before is not None:
+        descending = ['-{0}'.format(key) for key in keys]
+        rows = list(queryset.filter(keyset_filter(keys, before, 'lt')).order_by(*descending)
+                    [:per_page + 1])
+        return KeysetPage(queryset, rows[per_page - 1::-1], keys, len(rows) > per_page, True)
+    rows = list(queryset.order_by(*keys)[:per_page + 1])
+    return KeysetPage(queryset, rows[:per_page], keys, False, len(rows) > per_page)
@@ -0,0 +1,23 @@
+from collections import OrderedDict
+
+
+class LRUMemo(object):
+    """
+    Memoize a pure single argument function, keeping the results for the maxsize most recently used arguments.
+    Exceptions are not memoized.
+    """
+    def __init__(self, function, maxsize=1024):
+        super(LRUMemo, self).__init__()
+        self.function = function
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+
+    def __call__(self, arg):
+        try:
+            result = self.results.pop(arg)
+        except KeyError:
+            result = self.function(arg)
+            if len(self.results) >= self.maxsize:
+                self.results.popitem(last=False)  # least recently used
+        self.results[arg] = result
+        return result
@@ -1,7 +1,13 @@
 from collections import defaultdict
+from functools import partial
+import json
 import os
 
+from django.conf import settings
+from django.core.urlresolvers import reverse
 from django.http.response import Http404, HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
@@ -11,32 +17,117 @@ from django.shortcuts import get_object_or_404
 from mezzanine.utils.views import paginate
 
 import docmeta.models as dm
+from docmeta import cache
+from docmeta.utils.keyset_pagination import keyset_paginate
 
 
-class RootCategoriesView(TemplateView):
+class CategoryTreeMixin(object):
+    """
+    Context for rendering category trees in a fragment cached until any category changes.
+    Lazy trees (settings.DOCMETA_LAZY_CATEGORY_TREE) only render the top level; tree.js fetches the children of a
+    node from category_children when it is expanded.
+    """
+    category_tree_timeout = 60 * 60 * 24
+    lazy_category_tree = None  # default settings.DOCMETA_LAZY_CATEGORY_TREE
+
+    def get_lazy_category_tree(self):
+        if self.lazy_category_tree is None:
+            return getattr(settings, 'DOCMETA_LAZY_CATEGORY_TREE', False)
+        return self.lazy_category_tree
+
+    def get_context_data(self, **kwargs):
+        context = super(CategoryTreeMixin, self).get_context_data(**kwargs)
+        context['category_tree_version'] = cache.get_version(cache.CATEGORY_TREE)
+        context['category_tree_timeout'] = self.category_tree_timeout
+        context['lazy_category_tree'] = self.get_lazy_category_tree()
+        # the stored counts include unpublished documents
+        context['show_document_counts'] = self.request.user.is_staff
+        return context
+
+
+def get_cached_root_categories():
+    return cache.get_or_set(cache.CATEGORY_TREE, ('roots',), lambda: list(dm.get_root_categories()))
+
+
+def get_cached_orphan_document_ids():
+    """
+    :return: ids (in title order) of the documents in no category; only the ids are cached so the value stays small
+    """
+    return cache.get_or_set(cache.DOCUMENT_MEMBERSHIP, ('orphan-ids',),
+                            lambda: list(dm.get_orphan_documents().values_list('pk', flat=True)))
+
+
+class RootCategoriesView(CategoryTreeMixin, TemplateView):
+    """
+    The category tree and the documents in no category. Both are read per request through the cache, whose versions
+    are bumped when categories or document memberships change.
+    """
     template_name = 'docmeta/category_roots.html'
-    categories = dm.get_root_categories()
+    mezz_paginate_by = 25
 
     def get_context_data(self, **kwargs):
         context = super(RootCategoriesView, self).get_context_data(**kwargs)
-        context['categories'] = self.categories
-        context['document_list'] = dm.get_orphan_documents()
+        # only called (by the template) if the tree isn't cached
+        context['categories'] = (get_cached_root_categories if context['lazy_category_tree']
+                                 else dm.get_category_tree)
+        context['document_list'] = self.get_orphan_documents_page()
         return context
 
+    def get_orphan_documents_page(self):
+        """
+        :return: page of the orphan documents, loaded by id from the cached orphan ids
+        """
+        page = paginate(get_cached_orphan_document_ids(), self.request.GET.get("page", 1), self.mezz_paginate_by, 7)
+        documents = dm.Document.objects.in_bulk(list(page.object_list))
+        page.object_list = [documents[pk] for pk in page.object_list if pk in documents]
+        return page
+
 
 class DocumentListView(ListView):
     model = dm.Document
     mezz_paginate_by = 25
+    keyset_pagination = None  # default settings.DOCMETA_KEYSET_PAGINATION
+
+    def get_keyset_pagination(self):
+        if self.keyset_pagination is None:
+            return getattr(settings, 'DOCMETA_KEYSET_PAGINATION', False)
+        return self.keyset_pagination
 
     def get_context_data(self, **kwargs):
         context = super(DocumentListView, self).get_context_data(**kwargs)
-        context['document_list'] = paginate(
-            context['document_list'],
-            self.request.GET.get("page", 1),
-            self.mezz_paginate_by,
-            7)
+        if self.get_keyset_pagination():
+            context.update(self.get_keyset_context(context['document_list']))
+        else:
+            context['document_list'] = paginate(
+                context['document_list'],
+                self.request.GET.get("page", 1),
+                self.mezz_paginate_by,
+                7)
         return context
 
+    def get_keyset_context(self, documents):
+        """
+        Page through documents by (title, id) from the after/before cursors rather than by offset
+        """
+        try:
+            page = keyset_paginate(documents, self.request.GET.get('after'), self.request.GET.get('before'),
+                                   self.mezz_paginate_by)
+        except ValueError:  # bad cursor so start at the beginning (as paginate does for a bad page)
+            page = keyset_paginate(documents, per_page=self.mezz_paginate_by)
+        context = {'document_list': page, 'keyset_page': page, 'keyset_pagination': True}
+        if page.has_next:
+            context['keyset_next_query'] = self.get_keyset_query('after', page.next_cursor)
+        if page.has_previous:
+            context['keyset_previous_query'] = self.get_keyset_query('before', page.previous_cursor)
+        return context
+
+    def get_keyset_query(self, name, cursor):
+        query = self.request.GET.copy()
+        for key in ('after', 'before', 'page'):
+            query.pop(key, None)
+        query[name] = cursor
+        return query.urlencode()
+
     def get_queryset(self):
         queryset = super(DocumentListView, self).get_queryset()
         if not self.request.user.is_staff:
@@ -64,7 +155,7 @@ class DocumentDuplicatesView(ListView):
         for document in documents:
             if document.sha is None:
                 document.update_sha()
-                document.save()
+                document.save_changed()
             sha_dict[document.sha[:8]].append(document)
 
         # Remove all entries with just one document
@@ -82,17 +173,39 @@ class DocumentDeleteView(DeleteView):
         return self.request.GET['next']
 
 
-class CategoryView(DocumentListView):
+class CategoryView(CategoryTreeMixin, DocumentListView):
     template_name = 'docmeta/category.html'
     categories = []
+    include_descendants = False  # list the documents of the subcategories too (overridden by ?descendants=0/1)
+
+    def get_include_descendants(self):
+        descendants = self.request.GET.get('descendants')
+        if descendants is None:
+            return self.include_descendants
+        return descendants not in ('', '0')
 
     def get_queryset(self):
         qs = super(CategoryView, self).get_queryset()
-        return qs.filter(categories=self.categories[-1])
+        category = self.categories[-1]
+        if self.get_include_descendants():  # semi-join on the subtree's lft/rght range so no DISTINCT is needed
+            links = dm.Document.categories.through.objects.filter(documentcategory__tree_id=category.tree_id,
+                                                                  documentcategory__lft__gte=category.lft,
+                                                                  documentcategory__rght__lte=category.rght)
+            return qs.filter(pk__in=links.values('document'))
+        return qs.filter(categories=category)
 
     def get_context_data(self, **kwargs):
         context = super(CategoryView, self).get_context_data(**kwargs)
         context['category'] = self.categories[-1]
+        context['include_descendants'] = self.get_include_descendants()
+        # the stored count includes unpublished documents so only matches the list for staff
+        context['show_stored_document_count'] = self.request.user.is_staff and not context['include_descendants']
+        context['parent_category'] = self.categories[-2] if len(self.categories) > 1 else None
+        # called (by the template) if the tree isn't cached
+        if context['lazy_category_tree']:
+            context['subcategories'] = self.categories[-1].get_children
+        else:
+            context['subcategories'] = partial(dm.get_category_tree, self.categories[-1])
         return context
 
     def dispatch(self, request, *args, **kwargs):
@@ -128,4 +241,55 @@ def download(request, slug):
     response = HttpResponse(document.source_file, content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename={0}'.format(filename)
 
-    return response
\ No newline at end of file
+    return response
+
+
+CATEGORY_CHILDREN_MAX_AGE = 60
+
+
+def category_json(category, document_counts=False):
+    """
+    :param document_counts: if True include the (stored, so including unpublished) document counts
+    :return: dict describing category for category_children
+    """
+    data = {
+        'id': category.pk,
+        'name': category.name,
+        'label': unicode(category),
+        'url': category.get_absolute_url(),
+        'children_url': (reverse('document-category-children', args=(category.pk,))
+                         if category.get_descendant_count() else None)}
+    if document_counts:
+        data['document_count'] = category.document_count
+        data['subtree_document_count'] = category.subtree_document_count
+    return data
+
+
+def category_children_etag(request, pk=None):
+    return '{0}-{1}-{2}'.format(cache.get_version(cache.CATEGORY_TREE), pk or 'root',
+                                'staff' if request.user.is_staff else 'public')
+
+
+@condition(etag_func=category_children_etag)
+def category_children(request, pk=None):
+    """
+    The children of category pk (or the root categories) as JSON for lazily expanded trees.
+    Responses are cached, and their ETag valid, until any category changes. Document counts are only included for
+    staff.
+    :param request:
+    :param pk: category id
+    :return: response
+    """
+    def get_content():
+        if pk is None:
+            categories = dm.get_root_categories()
+        else:
+            categories = get_object_or_404(dm.DocumentCategory, pk=pk).get_children()
+        return json.dumps({'children': [category_json(category, staff) for category in categories]})
+
+    staff = request.user.is_staff
+    content = cache.get_or_set(cache.CATEGORY_TREE, ('children', pk or 'root', staff), get_content)
+    response = HttpResponse(content, content_type='application/json')
+    patch_cache_control(response, max_age=CATEGORY_CHILDREN_MAX_AGE)
+    patch_vary_headers(response, ('Cookie',))  # staff and public responses differ
+    return response